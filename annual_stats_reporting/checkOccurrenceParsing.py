@@ -0,0 +1,55 @@
+# Check of the block-wise parsing of occurrence files in occurrenceProcessing.py.
+# A small occurrence file with malformed lines is read in blocks of a few lines, with a block starting with a line that has
+# an extra field, and the result is compared with a single pass of the python parser over the whole file.
+# Run it with: python checkOccurrenceParsing.py
+
+import csv
+import io
+import zipfile
+import pandas as pd
+import occurrenceProcessing
+
+# The occurrence columns plus a column that is not read, as in the GBIF files
+file_columns = occurrenceProcessing.occurrence_columns + ["license"]
+
+# Build a line of the occurrence file for row number i
+def occurrence_line(i):
+    values = {col: f"{col}-{i}" for col in file_columns}
+    values.update({"gbifID": str(1000 + i), "taxonKey": str(i), "speciesKey": str(i % 7),
+                   "datasetKey": f"dataset-{i % 3}", "kingdom": "Plantae", "basisOfRecord": "PRESERVED_SPECIMEN"})
+    return "\t".join(values[col] for col in file_columns) + "\n"
+
+def main():
+    lines = [occurrence_line(i) for i in range(1, 21)]
+    too_long = occurrence_line(5).replace("\n", "\textra\n")
+    too_short = "\t".join(occurrence_line(11).split("\t")[:5]) + "\n"
+    # With blocks of 2 lines, the too-long line starts the third block and the too-short line ends the sixth
+    lines[4] = too_long
+    lines[11] = too_short
+    header = "\t".join(file_columns) + "\n"
+
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as z:
+        z.writestr("occurrence.txt", header + "".join(lines))
+
+    occurrenceProcessing.read_block_lines = 2
+    with zipfile.ZipFile(buffer) as z:
+        df, bad_line_count, bad_value_count = occurrenceProcessing.read_occurrence_csv(
+            z, "occurrence.txt", occurrenceProcessing.occurrence_columns
+        )
+
+    # Single pass of the python parser over the whole file, which cuts the too-long line to the header's columns and pads
+    # the too-short line. The block parser must give the same rows, and count both lines as malformed.
+    reference = pd.read_csv(
+        io.StringIO(header + "".join(lines)), engine="python", sep="\t", quoting=csv.QUOTE_NONE, escapechar="\\",
+        usecols=occurrenceProcessing.occurrence_columns, dtype=occurrenceProcessing.occurrence_dtypes
+    )
+    occurrenceProcessing.convert_integer_columns(reference)
+
+    assert bad_line_count == 2, f"Expected 2 bad lines, got {bad_line_count}"
+    assert bad_value_count == 0, f"Expected no bad key values, got {bad_value_count}"
+    pd.testing.assert_frame_equal(df.astype(object), reference.astype(object))
+    print(f"Block parsing matches the single-pass parse: {len(df)} rows, {bad_line_count} bad lines")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+# Local cache of GBIF dataset names used by occurrenceProcessing.py, kept in a small SQLite file in the zip folder.
+# For each dataset key it records the title from the GBIF registry and when it was looked up, so a re-run only asks
+# GBIF for datasets it has not seen or whose name is older than the maximum age.
+# In offline mode only the cached names are used (whatever their age), and GBIF is not contacted at all.
+
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pygbif import registry
+
+unknown_dataset_name = "Unknown Dataset"
+
+# Open (and create if needed) the cache database
+def open_name_cache(cache_path):
+    os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+    conn = sqlite3.connect(cache_path)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS dataset_names (
+            dataset_key TEXT PRIMARY KEY,
+            title TEXT NOT NULL,
+            fetched REAL NOT NULL
+        )
+    """)
+    return conn
+
+# Get the cached names of dataset keys looked up at or after a unix timestamp, as {dataset_key: title}
+def get_cached_names(conn, dataset_keys, since=0):
+    names = {}
+    dataset_keys = list(dataset_keys)
+    # Stay below the SQLite limit on the number of parameters
+    for start in range(0, len(dataset_keys), 500):
+        batch = dataset_keys[start:start + 500]
+        rows = conn.execute(
+            f"SELECT dataset_key, title FROM dataset_names WHERE fetched >= ? AND dataset_key IN ({','.join('?' * len(batch))})",
+            [since, *batch]
+        ).fetchall()
+        names.update(rows)
+    return names
+
+# Save looked up names, as {dataset_key: title}
+def save_names(conn, names):
+    fetched = time.time()
+    with conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO dataset_names (dataset_key, title, fetched) VALUES (?, ?, ?)",
+            [(dataset_key, title, fetched) for dataset_key, title in names.items()]
+        )
+
+# Look up the name of a dataset in the GBIF registry. Returns None if the lookup fails, so the failure is not cached.
+def fetch_dataset_name(dataset_key):
+    try:
+        dataset_info = registry.datasets(uuid=dataset_key)
+        return dataset_info.get("title", unknown_dataset_name)
+    except Exception as e:
+        print(f"Error fetching dataset name for {dataset_key}: {e}")
+        return None
+
+# Get the names of dataset keys, as {dataset_key: title}. Each unique key is looked up at most once: names cached less
+# than max_age seconds ago are used as they are, and the other keys are looked up concurrently and saved to the cache.
+# In offline mode cached names of any age are used. Keys without a name get "Unknown Dataset".
+def resolve_dataset_names(dataset_keys, cache_path, max_age, offline=False, max_workers=8, fetch=fetch_dataset_name):
+    dataset_keys = {key for key in dataset_keys if isinstance(key, str) and key}
+    conn = open_name_cache(cache_path)
+    try:
+        names = get_cached_names(conn, dataset_keys, since=0 if offline else time.time() - max_age)
+        missing_keys = sorted(dataset_keys - names.keys())
+
+        if missing_keys and offline:
+            print(f"Offline mode: no cached name for {len(missing_keys)} dataset(s)")
+        elif missing_keys:
+            print(f"Looking up {len(missing_keys)} dataset name(s) in the GBIF registry")
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                fetched = dict(zip(missing_keys, executor.map(fetch, missing_keys)))
+            fetched = {key: title for key, title in fetched.items() if title is not None}
+            save_names(conn, fetched)
+            names.update(fetched)
+    finally:
+        conn.close()
+
+    return {key: names.get(key, unknown_dataset_name) for key in dataset_keys}
@@ -0,0 +1,74 @@
+# Local registry of the GBIF downloads made by gbifOccurrenceSearch.py, kept in a small SQLite file in the zip folder.
+# For each download it records the key, the predicate (as sorted JSON of the search terms) and when it was created,
+# and for each zip file which download it holds, with its size, mtime and sha256.
+# This lets a re-run reuse a recent download for the same predicate instead of requesting a new one,
+# and skip fetching a zip file that is already on disk.
+
+import hashlib
+import json
+import os
+import sqlite3
+
+# Open (and create if needed) the registry database
+def open_registry(registry_path):
+    os.makedirs(os.path.dirname(os.path.abspath(registry_path)), exist_ok=True)
+    conn = sqlite3.connect(registry_path)
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS downloads (
+            download_key TEXT PRIMARY KEY,
+            publisher_uuid TEXT NOT NULL,
+            predicate TEXT NOT NULL,
+            created TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_downloads_predicate ON downloads (predicate, created);
+        CREATE TABLE IF NOT EXISTS zip_files (
+            zip_file TEXT PRIMARY KEY,
+            download_key TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            mtime REAL NOT NULL,
+            sha256 TEXT NOT NULL
+        );
+    """)
+    return conn
+
+# Store a predicate as sorted JSON of its search terms, so the same terms always give the same text
+def predicate_text(terms):
+    return json.dumps(terms, sort_keys=True)
+
+# Calculate the content hash of a file, reading it in chunks
+def file_sha256(path, chunk_size=1024 * 1024):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+# Save a download requested (or found in the GBIF download list) for a predicate. created is an ISO 8601 timestamp.
+def save_download(conn, download_key, publisher_uuid, predicate, created):
+    with conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO downloads (download_key, publisher_uuid, predicate, created) VALUES (?, ?, ?, ?)",
+            (download_key, publisher_uuid, predicate, created)
+        )
+
+# Get the downloads for a predicate created at or after a timestamp, as (download_key, created), newest first
+def get_recent_downloads(conn, predicate, since):
+    return conn.execute(
+        "SELECT download_key, created FROM downloads WHERE predicate = ? AND created >= ? ORDER BY created DESC",
+        (predicate, since)
+    ).fetchall()
+
+# Save which download a zip file holds, with its size, mtime and content hash
+def save_zip_file(conn, zip_file, download_key, sha256):
+    stat = os.stat(zip_file)
+    with conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO zip_files (zip_file, download_key, size, mtime, sha256) VALUES (?, ?, ?, ?, ?)",
+            (zip_file, download_key, stat.st_size, stat.st_mtime, sha256)
+        )
+
+# Get the registry entry of a zip file as (download_key, size, mtime, sha256), or None
+def get_zip_file(conn, zip_file):
+    return conn.execute(
+        "SELECT download_key, size, mtime, sha256 FROM zip_files WHERE zip_file = ?", (zip_file,)
+    ).fetchone()
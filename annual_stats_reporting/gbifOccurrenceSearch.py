@@ -3,12 +3,19 @@
 # See .env file for variables that need updating before this script will run
 
 from pygbif import occurrences
-import time
+import asyncio
 import requests
 import pandas as pd
 import os
+import glob
+import time
 import json
+import zipfile
+from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
+from downloadRegistry import (
+    file_sha256, get_recent_downloads, get_zip_file, open_registry, predicate_text, save_download, save_zip_file
+)
 
 # Load environment variables from the .env file
 load_dotenv()
@@ -33,42 +40,298 @@ publishers = [
 if not os.path.exists(zip_folder_path):
     os.makedirs(zip_folder_path)
 
-# Function to request and download data
-def download_gbif_data(publisher_uuid, publisher_name):
+# GBIF API used to check the status of downloads and fetch them (can be pointed at a local stand-in server for testing)
+gbif_api_url = os.getenv("GBIF_API_URL") or "https://api.gbif.org/v1"
+
+# Seconds to wait between status checks of a download: starts at POLL_INTERVAL and grows by POLL_BACKOFF up to MAX_POLL_INTERVAL
+poll_interval = float(os.getenv("POLL_INTERVAL") or 30)
+poll_backoff = float(os.getenv("POLL_BACKOFF") or 1.5)
+max_poll_interval = float(os.getenv("MAX_POLL_INTERVAL") or 300)
+
+# Waiting for a download stops with an error after MAX_STATUS_ERRORS failed status checks in a row (e.g. the network is down),
+# or when it has not succeeded after MAX_WAIT_HOURS hours
+max_status_errors = int(os.getenv("MAX_STATUS_ERRORS") or 10)
+max_wait_time = float(os.getenv("MAX_WAIT_HOURS") or 24) * 60 * 60
+
+# ZIP files are written to disk in chunks of this many bytes, and a dropped download is resumed up to MAX_DOWNLOAD_ATTEMPTS times
+download_chunk_size = 1024 * 1024
+download_timeout = 60
+max_download_attempts = int(os.getenv("MAX_DOWNLOAD_ATTEMPTS") or 5)
+
+# A download for the same predicate created less than MAX_DOWNLOAD_AGE_DAYS days ago is reused instead of requesting a new one
+max_download_age = timedelta(days=float(os.getenv("MAX_DOWNLOAD_AGE_DAYS") or 7))
+
+# Registry of the downloads made so far and the zip files they were saved to
+registry_path = os.path.join(zip_folder_path, "downloadRegistry.db")
+
+# Download statuses that mean the download will never succeed
+failed_statuses = {"CANCELLED", "FAILED", "KILLED", "FILE_ERASED"}
+
+# Search terms of the download for a publisher, as GBIF reports them in the download predicate
+# These must match the query in submit_download
+def get_query_terms(publisher_uuid):
+    return {
+        "PUBLISHING_ORG": publisher_uuid,
+        "BASIS_OF_RECORD": "PRESERVED_SPECIMEN",
+        "OCCURRENCE_STATUS": "PRESENT",
+    }
+
+# Request a download for a publisher and return the download key
+def submit_download(publisher_uuid):
     # Create the download query as a tuple
     query = (
         f"publishingOrg = {publisher_uuid}",
         "basisOfRecord = PRESERVED_SPECIMEN",
         "occurrenceStatus = PRESENT",
     )
-    
-    # Request the download
-    print(f"Requesting data for {publisher_name} ({publisher_uuid})...")
     result = occurrences.download(query, user=gbif_user, pwd=gbif_password, email=gbif_email)
-    
     # Extract the download key (first element of the tuple)
-    download_key = result[0]
-    print(f"Download key: {download_key}")
-    
+    return result[0]
+
+# Get the search terms of a download predicate (a single 'equals' or an 'and' of 'equals'), or None for any other predicate
+def get_predicate_terms(predicate):
+    predicates = predicate.get("predicates", []) if predicate.get("type") == "and" else [predicate]
+    if not predicates or any(p.get("type") != "equals" for p in predicates):
+        return None
+    return {p["key"]: p["value"] for p in predicates}
+
+# Convert a GBIF timestamp (e.g. 2025-01-31T10:00:00.000+00:00) to UTC in ISO 8601, so timestamps can be compared as text
+def to_utc_timestamp(timestamp):
+    return datetime.fromisoformat(timestamp).astimezone(timezone.utc).isoformat(timespec="seconds")
+
+# List the user's own GBIF downloads created at or after a timestamp, as dicts with key, created (UTC) and predicate (terms)
+def list_user_downloads(since):
+    downloads = []
+    offset = 0
+    while True:
+        response = requests.get(
+            f"{gbif_api_url}/occurrence/download/user/{gbif_user}",
+            params={"limit": 100, "offset": offset},
+            auth=(gbif_user, gbif_password)
+        )
+        response.raise_for_status()
+        data = response.json()
+
+        for download in data.get("results", []):
+            request = download.get("request") or {}
+            created = to_utc_timestamp(download["created"])
+            if created >= since and request.get("format") == "SIMPLE_CSV" and request.get("predicate"):
+                downloads.append({
+                    "key": download["key"],
+                    "created": created,
+                    "status": download.get("status"),
+                    "predicate": get_predicate_terms(request["predicate"])
+                })
+
+        # The list is newest first, so stop at the first page that reaches past the time limit
+        results = data.get("results", [])
+        if data.get("endOfRecords", True) or not results or to_utc_timestamp(results[-1]["created"]) < since:
+            return downloads
+        offset += len(results)
+
+# Get the metadata of a download (status, size, number of records, etc.)
+def get_download_meta(download_key):
+    response = requests.get(f"{gbif_api_url}/occurrence/download/{download_key}")
+    response.raise_for_status()
+    return response.json()
+
+# Get the status of a download, e.g. PREPARING, RUNNING or SUCCEEDED
+def get_download_status(download_key):
+    return get_download_meta(download_key)["status"]
+
+# Check a downloaded ZIP file against the size in the download metadata, and check the CRC-32 checksum of every file in it
+def verify_download(zip_file, expected_size):
+    size = os.path.getsize(zip_file)
+    if expected_size is not None and size != expected_size:
+        raise ValueError(f"{zip_file} is {size} bytes, expected {expected_size} bytes")
+    with zipfile.ZipFile(zip_file) as z:
+        bad_file = z.testzip()
+    if bad_file is not None:
+        raise ValueError(f"Checksum error in {bad_file} in {zip_file}")
+
+# Download the ZIP file of a finished download.
+# The file is streamed to disk in chunks into a .part file, so memory use does not depend on the size of the archive.
+# If the connection drops, the download is resumed from the end of the .part file with an HTTP Range request.
+# The .part file is named after the download key, so only a part of the same download is resumed; parts of other downloads
+# to the same ZIP file are removed. The .part file is only renamed to the ZIP file once it has been verified.
+def fetch_download(download_key, zip_file):
+    expected_size = get_download_meta(download_key).get("size")
+    download_url = f"{gbif_api_url}/occurrence/download/request/{download_key}"
+    part_file = f"{zip_file}.{download_key}.part"
+    for old_part_file in glob.glob(f"{glob.escape(zip_file)}.*.part") + glob.glob(f"{glob.escape(zip_file)}.part"):
+        if old_part_file != part_file:
+            os.remove(old_part_file)
+
+    failed_attempts = 0
+    while True:
+        offset = os.path.getsize(part_file) if os.path.exists(part_file) else 0
+        if expected_size is not None and offset == expected_size:
+            break
+        if expected_size is not None and offset > expected_size:
+            # Larger than the download, start over
+            offset = 0
+
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        try:
+            with requests.get(download_url, headers=headers, stream=True, timeout=download_timeout) as response:
+                if offset and response.status_code == 416:
+                    # Nothing left to download
+                    break
+                response.raise_for_status()
+                if offset and response.status_code != 206:
+                    # The server ignored the Range header and is sending the whole file
+                    offset = 0
+                with open(part_file, "ab" if offset else "wb") as file:
+                    for chunk in response.iter_content(chunk_size=download_chunk_size):
+                        file.write(chunk)
+            if expected_size is None or os.path.getsize(part_file) >= expected_size:
+                break
+            raise requests.ConnectionError("connection closed before the end of the file")
+        except requests.RequestException as e:
+            failed_attempts += 1
+            if failed_attempts >= max_download_attempts:
+                raise
+            print(f"Download of {download_key} interrupted ({e}), resuming")
+
+    try:
+        verify_download(part_file, expected_size)
+    except Exception:
+        # Start from scratch next time
+        os.remove(part_file)
+        raise
+    os.replace(part_file, zip_file)
+
+# Wait until a download has succeeded, checking its status less and less often (the blocking calls run in a thread).
+# Raises RuntimeError if the download has failed or is unknown to GBIF (404), if max_errors status checks in a row have failed,
+# or if the download has not succeeded after max_wait seconds.
+async def wait_for_download(download_key, get_status, interval, backoff, max_interval, max_errors=max_status_errors,
+                            max_wait=max_wait_time):
+    deadline = time.monotonic() + max_wait
+    error_count = 0
+    while True:
+        try:
+            download_status = await asyncio.to_thread(get_status, download_key)
+            error_count = 0
+        except requests.HTTPError as e:
+            if e.response is not None and e.response.status_code == 404:
+                raise RuntimeError(f"Download {download_key} was not found") from e
+            error_count += 1
+            download_status = f"unknown ({e})"
+        except Exception as e:
+            # A failed status check is not a failed download, so keep checking
+            error_count += 1
+            download_status = f"unknown ({e})"
+
+        if download_status == "SUCCEEDED":
+            return
+        if download_status in failed_statuses:
+            raise RuntimeError(f"Download {download_key} ended with status {download_status}")
+        if error_count >= max_errors:
+            raise RuntimeError(f"Could not check the status of download {download_key} {error_count} times in a row: {download_status}")
+        if time.monotonic() + interval > deadline:
+            raise RuntimeError(f"Download {download_key} has not succeeded after {max_wait / 3600:g} hours (status {download_status})")
+
+        print(f"Status of {download_key}: {download_status} (waiting {interval:.0f} seconds)")
+        await asyncio.sleep(interval)
+        interval = min(interval * backoff, max_interval)
+
+# Get a download key for a publisher: a download created since the given time for the same predicate from the local registry,
+# or else from the user's GBIF downloads, as long as it has not failed or been erased. Only if there is none is a new download requested.
+async def get_download_key(publisher_uuid, publisher_name, registry, since, user_downloads, submit, get_status):
+    terms = get_query_terms(publisher_uuid)
+    predicate = predicate_text(terms)
+
+    candidates = get_recent_downloads(registry, predicate, since)
+    if not candidates:
+        candidates = [(d["key"], d["created"]) for d in user_downloads if d["predicate"] == terms]
+
+    for download_key, created in candidates:
+        try:
+            download_status = await asyncio.to_thread(get_status, download_key)
+        except Exception as e:
+            print(f"Could not check download {download_key}: {e}")
+            continue
+        if download_status not in failed_statuses:
+            print(f"Reusing download {download_key} for {publisher_name} (created {created}, status {download_status})")
+            save_download(registry, download_key, publisher_uuid, predicate, created)
+            return download_key
+
+    # Request the download
+    print(f"Requesting data for {publisher_name} ({publisher_uuid})...")
+    download_key = await asyncio.to_thread(submit, publisher_uuid)
+    save_download(registry, download_key, publisher_uuid, predicate, datetime.now(timezone.utc).isoformat(timespec="seconds"))
+    return download_key
+
+# Check whether a zip file already holds a download: the registry says so and the file is unchanged
+# (same size and mtime, or else the same content hash)
+async def is_already_fetched(registry, zip_file, download_key):
+    entry = get_zip_file(registry, zip_file)
+    if entry is None or entry[0] != download_key or not os.path.exists(zip_file):
+        return False
+
+    stat = os.stat(zip_file)
+    if (stat.st_size, stat.st_mtime) == (entry[1], entry[2]):
+        return True
+    if await asyncio.to_thread(file_sha256, zip_file) == entry[3]:
+        save_zip_file(registry, zip_file, download_key, entry[3])
+        return True
+    return False
+
+# Function to request and download data for one publisher. The ZIP file is fetched as soon as the download is ready.
+async def download_gbif_data(publisher_uuid, publisher_name, registry, since, user_downloads, submit, get_status, fetch,
+                             interval, backoff, max_interval):
+    download_key = await get_download_key(publisher_uuid, publisher_name, registry, since, user_downloads, submit, get_status)
+    print(f"Download key for {publisher_name}: {download_key}")
+
     # Wait for the download to complete
-    download_status = occurrences.download_meta(download_key)["status"]
-    while download_status != "SUCCEEDED":
-        print(f"Status: {download_status} (waiting 30 seconds)")
-        time.sleep(30)
-        download_status = occurrences.download_meta(download_key)["status"]
-    
-    # Download the ZIP file
-    download_url = f"https://api.gbif.org/v1/occurrence/download/request/{download_key}"
-    response = requests.get(download_url)
+    await wait_for_download(download_key, get_status, interval, backoff, max_interval)
+
+    # Download the ZIP file, unless it has already been downloaded
     zip_file = f"{zip_folder_path}{publisher_name.replace(' ', '_')}_download.zip"
-    
-    with open(zip_file, "wb") as file:
-        file.write(response.content)
-    
+    if await is_already_fetched(registry, zip_file, download_key):
+        print(f"{zip_file} already holds download {download_key}, not downloading it again")
+        return zip_file
+
+    await asyncio.to_thread(fetch, download_key, zip_file)
+    save_zip_file(registry, zip_file, download_key, await asyncio.to_thread(file_sha256, zip_file))
+
     print(f"Download completed for {publisher_name} ({publisher_uuid}). File saved as {zip_file}")
     return zip_file
 
-# Download data for each publisher
-for publisher in publishers:
-    zip_file = download_gbif_data(publisher["uuid"], publisher["name"])
-    print(f"Download ready: {zip_file}")
\ No newline at end of file
+# Request the downloads for all publishers at once and wait for them at the same time, so the GBIF queue waits overlap.
+# submit, get_status, fetch and list_downloads can be replaced, e.g. to test against a local stand-in server.
+# Returns a dict from publisher name to the ZIP file, or to the error if the download failed.
+async def download_all_publishers(publishers, submit=submit_download, get_status=get_download_status, fetch=fetch_download,
+                                  list_downloads=list_user_downloads, interval=poll_interval, backoff=poll_backoff,
+                                  max_interval=max_poll_interval):
+    registry = open_registry(registry_path)
+    try:
+        since = (datetime.now(timezone.utc) - max_download_age).isoformat(timespec="seconds")
+
+        # Only list the user's GBIF downloads (once) if a publisher has no recent download in the local registry
+        user_downloads = []
+        if any(not get_recent_downloads(registry, predicate_text(get_query_terms(p["uuid"])), since) for p in publishers):
+            try:
+                user_downloads = await asyncio.to_thread(list_downloads, since)
+            except Exception as e:
+                print(f"Could not list the GBIF downloads of {gbif_user}: {e}")
+
+        results = await asyncio.gather(
+            *(
+                download_gbif_data(publisher["uuid"], publisher["name"], registry, since, user_downloads, submit, get_status,
+                                   fetch, interval, backoff, max_interval)
+                for publisher in publishers
+            ),
+            return_exceptions=True
+        )
+    finally:
+        registry.close()
+    return {publisher["name"]: result for publisher, result in zip(publishers, results)}
+
+if __name__ == "__main__":
+    # Download data for all publishers
+    for publisher_name, result in asyncio.run(download_all_publishers(publishers)).items():
+        if isinstance(result, Exception):
+            print(f"Download failed for {publisher_name}: {result}")
+        else:
+            print(f"Download ready: {result}")
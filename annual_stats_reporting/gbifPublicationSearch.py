@@ -2,7 +2,14 @@ import pandas as pd
 import requests
 import time
 import os
+import json
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from requests.adapters import HTTPAdapter
 import re
 
 # Load environment variables
@@ -12,35 +19,169 @@ load_dotenv()
 output_folder_path = os.getenv("output_folder_path", "./")
 year = os.getenv("YEAR", "2025") # Default to 2024 if not set in .env
 
+# GBIF API address, e.g. to test against a local stand-in server
+gbif_api_url = os.getenv("GBIF_API_URL") or "https://api.gbif.org/v1"
+# Number of dataset keys searched at the same time
+max_workers = int(os.getenv("LITERATURE_WORKERS") or 8)
+# GBIF does not publish a fixed request limit, but answers 429 (Too Many Requests) when clients go too fast.
+# Requests are spread out by a token bucket: at most REQUESTS_PER_SECOND on average, with bursts of up to RATE_LIMIT_BURST.
+# 429 and 5xx responses and connection errors are retried (up to MAX_REQUEST_ATTEMPTS times) after the Retry-After time
+# GBIF sends, or with exponential backoff. Every attempt takes a token, and a 429 pauses all workers until Retry-After.
+requests_per_second = float(os.getenv("REQUESTS_PER_SECOND") or 3)
+rate_limit_burst = int(os.getenv("RATE_LIMIT_BURST") or 3)
+max_request_attempts = int(os.getenv("MAX_REQUEST_ATTEMPTS") or 6)
+retry_statuses = {429, 500, 502, 503, 504}
+request_timeout = 60
+# Search results are cached by (datasetKey, year, offset), so re-runs and runs that crashed do not search again.
+# Cached pages older than LITERATURE_CACHE_MAX_AGE_DAYS (default 7) are fetched again, as new publications are added over time.
+literature_cache_path = os.getenv("LITERATURE_CACHE_PATH") or os.path.join(output_folder_path, "literatureCache.db")
+literature_cache_max_age = float(os.getenv("LITERATURE_CACHE_MAX_AGE_DAYS") or 7) * 24 * 60 * 60
+
+# Create a session that reuses connections (one pooled connection per worker). Retries are done by get_with_retries,
+# so that every attempt goes through the rate limiter.
+def create_session(pool_size):
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+# Create a token bucket rate limiter shared by all workers. Returns (acquire, pause): acquire waits until a request may be
+# made, and pause stops all requests for a number of seconds (e.g. the Retry-After time of a 429 response).
+def create_rate_limiter(rate, burst):
+    lock = threading.Lock()
+    state = {"tokens": float(burst), "updated": time.monotonic(), "paused_until": 0.0}
+
+    def acquire():
+        while True:
+            with lock:
+                now = time.monotonic()
+                state["tokens"] = min(burst, state["tokens"] + (now - state["updated"]) * rate)
+                state["updated"] = now
+                if now >= state["paused_until"] and state["tokens"] >= 1:
+                    state["tokens"] -= 1
+                    return
+                wait = max(state["paused_until"] - now, (1 - state["tokens"]) / rate)
+            time.sleep(wait)
+
+    def pause(seconds):
+        with lock:
+            state["paused_until"] = max(state["paused_until"], time.monotonic() + seconds)
+            # Start again slowly after the pause
+            state["tokens"] = 0.0
+
+    return acquire, pause
+
+session = create_session(max_workers)
+wait_for_rate_limit, pause_requests = create_rate_limiter(requests_per_second, rate_limit_burst)
+
+# Get the number of seconds to wait from a Retry-After header (seconds or an HTTP date), or None if there is none
+def get_retry_after(response):
+    retry_after = response.headers.get("Retry-After")
+    if not retry_after:
+        return None
+    if retry_after.strip().isdigit():
+        return float(retry_after)
+    try:
+        return max(0.0, (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+# Get a URL, taking a rate limiter token for every attempt and retrying rate-limited, failed and dropped requests.
+# Returns the response, or raises requests.RequestException when all attempts have failed.
+def get_with_retries(url):
+    for attempt in range(1, max_request_attempts + 1):
+        wait_for_rate_limit()
+        try:
+            response = session.get(url, timeout=request_timeout)
+        except requests.RequestException as e:
+            if attempt == max_request_attempts:
+                raise
+            print(f"Request failed ({e}), retrying")
+            time.sleep(2 ** attempt)
+            continue
+
+        if response.status_code not in retry_statuses:
+            response.raise_for_status()
+            return response
+        if attempt == max_request_attempts:
+            response.raise_for_status()
+
+        delay = get_retry_after(response) or 2 ** attempt
+        print(f"GBIF answered {response.status_code}, retrying in {delay:.0f} seconds")
+        if response.status_code == 429:
+            pause_requests(delay)
+        else:
+            time.sleep(delay)
+
+# Open (and create if needed) the search results cache
+def open_literature_cache(cache_path):
+    os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+    conn = sqlite3.connect(cache_path, timeout=60)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS literature_pages (
+            dataset_key TEXT NOT NULL,
+            year TEXT NOT NULL,
+            offset INTEGER NOT NULL,
+            response TEXT NOT NULL,
+            fetched REAL NOT NULL,
+            PRIMARY KEY (dataset_key, year, offset)
+        )
+    """)
+    return conn
+
+# Get a page of search results from the cache, or None if it is not cached (or too old)
+def get_cached_page(conn, dataset_key, year, offset):
+    row = conn.execute(
+        "SELECT response FROM literature_pages WHERE dataset_key = ? AND year = ? AND offset = ? AND fetched >= ?",
+        (dataset_key, year, offset, time.time() - literature_cache_max_age)
+    ).fetchone()
+    return json.loads(row[0]) if row else None
+
+# Save a page of search results to the cache
+def save_page(conn, dataset_key, year, offset, data):
+    with conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO literature_pages (dataset_key, year, offset, response, fetched) VALUES (?, ?, ?, ?, ?)",
+            (dataset_key, year, offset, json.dumps(data), time.time())
+        )
+
+# Fetch all search results for a dataset key. Returns (results, error), where error is None if all pages were fetched,
+# or the reason the search stopped (the results are then incomplete).
 def fetch_literature(dataset_key):
     all_results = []
     offset = 0  # Allows for pagination in search results
     limit = 300  # Maximum limit allowed by GBIF API
-    
-    while True:
-        url = f"https://api.gbif.org/v1/literature/search?gbifDatasetKey={dataset_key}&year={year}&limit={limit}&offset={offset}"
-        response = requests.get(url)
-        
-        if response.status_code == 200:
-            data = response.json()
+    conn = open_literature_cache(literature_cache_path)
+
+    try:
+        while True:
+            data = get_cached_page(conn, dataset_key, year, offset)
+            if data is None:
+                url = f"{gbif_api_url}/literature/search?gbifDatasetKey={dataset_key}&year={year}&limit={limit}&offset={offset}"
+                try:
+                    data = get_with_retries(url).json()
+                except (requests.RequestException, ValueError) as e:
+                    error = f"offset {offset}: {e}"
+                    print(f"Failed to fetch data for {dataset_key}: {error}")
+                    return all_results, error
+
+                save_page(conn, dataset_key, year, offset, data)
+
             results = data.get("results", [])
 
             print(f"Fetched {len(results)} results for datasetKey {dataset_key}, offset {offset}")  # Debugging line
 
-            if not results:
-                break  # No more results, exit loop
-            
             all_results.extend(results)  # Append all results
+            # Stop at the last page, without asking for an empty page after it
+            if not results or data.get("endOfRecords", len(results) < limit):
+                break
             offset += limit  # Move to the next page
-
-            time.sleep(1)  # Avoid hitting API rate limits
-
-        else:
-            print(f"Failed to fetch data for {dataset_key}: {response.status_code}")
-            break
+    finally:
+        conn.close()
 
     print(f"Total results fetched for {dataset_key}: {len(all_results)}")  # Debugging line
-    return all_results
+    return all_results, None
 
 def main(input_file, output_file):
     # Read dataset keys from spreadsheet
@@ -49,10 +190,23 @@ def main(input_file, output_file):
     
     all_results = []
     
-    # Pull data for each datasetKey
-    for dataset_key in dataset_keys:
-        print(f"Fetching literature for datasetKey: {dataset_key}")
-        publications = fetch_literature(dataset_key)
+    # Pull data for all datasetKeys, several at a time
+    print(f"Fetching literature for {len(dataset_keys)} datasetKeys")
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        all_publications = list(executor.map(fetch_literature, dataset_keys))
+
+    # Searches that stopped early are reported in failed_searches.csv and the "Failed Searches" sheet, as their counts are
+    # incomplete. The pages fetched before the failure are cached, so a re-run continues where the search stopped.
+    failed_searches = pd.DataFrame(
+        [(dataset_key, error) for dataset_key, (_, error) in zip(dataset_keys, all_publications) if error is not None],
+        columns=["datasetKey", "error"]
+    )
+    failed_searches.to_csv(os.path.join(output_folder_path, "failed_searches.csv"), index=False)
+    if not failed_searches.empty:
+        print(f"WARNING: the search failed for {len(failed_searches)} of {len(dataset_keys)} datasetKeys, their results are "
+              f"incomplete (see {output_folder_path}/failed_searches.csv)")
+
+    for dataset_key, (publications, _) in zip(dataset_keys, all_publications):
         for pub in publications:
             all_results.append({
                 "datasetKey": dataset_key,  # Ensure datasetKey is correctly assigned
@@ -126,6 +280,9 @@ def main(input_file, output_file):
             sheet_name='Unique Count by Dataset',
             index=False
         )
+
+        # datasetKeys whose search failed
+        failed_searches.to_excel(writer, sheet_name='Failed Searches', index=False)
         
         for publisher, group in publisher_groups:
             # Get unique publications only
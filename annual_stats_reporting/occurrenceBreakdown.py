@@ -0,0 +1,48 @@
+# Breakdowns of the occurrences by kingdom, class, family, basisOfRecord, collectionCode etc., used by occurrenceProcessing.py.
+# Each block of occurrences is grouped once by all breakdown columns and speciesKey together. These partial counts are small
+# (one row per combination that occurs) and can be added up over blocks, publishers and institutions, and every breakdown
+# (occurrences and unique species for each value of one column) is taken from them, so the occurrence files are only read
+# once however many breakdowns are asked for.
+
+import pandas as pd
+
+# Count the occurrences of each combination of the breakdown columns and speciesKey in a block of occurrences
+def partial_breakdown(df, columns):
+    partial = df.groupby(columns + ["speciesKey"], observed=True, dropna=False).size().reset_index(name="occurrences")
+    # Categoricals of different blocks have different categories, so the (few) values are kept as plain text
+    return partial.astype({col: object for col in columns})
+
+# Add up partial counts
+def combine_breakdowns(partials, columns):
+    partials = [partial for partial in partials if partial is not None]
+    if not partials:
+        return None
+    combined = pd.concat(partials, ignore_index=True)
+    return combined.groupby(columns + ["speciesKey"], dropna=False, sort=False)["occurrences"].sum().reset_index()
+
+# Get the breakdown by one column from partial counts: the occurrences and unique species (speciesKey) of each value
+def breakdown_by(partial, column):
+    grouped = partial.groupby(column, dropna=False)
+    return pd.DataFrame({
+        "occurrences": grouped["occurrences"].sum(),
+        "uniqueSpecies": grouped["speciesKey"].nunique(),
+    }).reset_index()
+
+# Get the breakdowns by each column for each publisher and for all publishers together, as {column: DataFrame}.
+# publisher_breakdowns is a list of (publisher name, partial counts) in publisher order.
+def breakdown_report(publisher_breakdowns, columns, all_publishers_name="All publishers"):
+    publisher_breakdowns = [(name, partial) for name, partial in publisher_breakdowns if partial is not None]
+    if not publisher_breakdowns:
+        return {column: pd.DataFrame(columns=["publisher", column, "occurrences", "uniqueSpecies"]) for column in columns}
+
+    all_publishers = combine_breakdowns([partial for _, partial in publisher_breakdowns], columns)
+    report = {}
+    for column in columns:
+        report[column] = pd.concat(
+            [
+                breakdown_by(partial, column).assign(publisher=name)
+                for name, partial in publisher_breakdowns + [(all_publishers_name, all_publishers)]
+            ],
+            ignore_index=True,
+        )[["publisher", column, "occurrences", "uniqueSpecies"]]
+    return report
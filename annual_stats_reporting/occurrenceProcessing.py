@@ -4,86 +4,321 @@
 
 import os
 import glob
+import io
+import itertools
+import shutil
+import warnings
 import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+import numpy as np
 import pandas as pd
 import csv
-from pygbif import registry
 from dotenv import load_dotenv
+from datasetNameCache import resolve_dataset_names
+from publisherKeyIndex import add_publisher, count_key_hashes, institution_summary, publisher_overlaps
+from occurrenceBreakdown import breakdown_report, combine_breakdowns, partial_breakdown
+from occurrenceStore import dataset_growth, finish_store_update, start_store_update, store_available, write_store_block
 
 # Load environment variables from the .env file
 load_dotenv()
 
-# Function to fetch dataset name by key
-def get_dataset_name(dataset_key):
-    try:
-        dataset_info = registry.datasets(uuid=dataset_key)
-        return dataset_info.get("title", "Unknown Dataset")
-    except Exception as e:
-        print(f"Error fetching dataset name for {dataset_key}: {e}")
-        return "Unknown Dataset"
-
-def process_existing_zip_files(publishers, zip_folder_path):
-    all_dataset_counts = pd.DataFrame()
-    all_summaries = pd.DataFrame()
-    all_duplicates = pd.DataFrame()
-
-    for publisher in publishers:
-        publisher_uuid = publisher["uuid"]
-        publisher_name = publisher["name"]
-        print(f"\nProcessing publisher: {publisher_name}")
-
-        # Group zip files by publisher
-        zip_files = glob.glob(os.path.join(zip_folder_path, f"{publisher_name.replace(' ', '_')}_*.zip"))
-        if not zip_files:
-            print(f"No ZIP files found for publisher: {publisher_name}")
+# Columns read from the GBIF occurrence files
+occurrence_columns = ["gbifID", "datasetKey", "occurrenceID", "kingdom", "phylum", "class", "order", "family", "genus",
+                      "species", "infraspecificEpithet", "taxonRank", "scientificName", "publishingOrgKey",
+                      "eventDate", "taxonKey", "speciesKey", "basisOfRecord", "institutionCode", "collectionCode",
+                      "catalogNumber", "lastInterpreted"]
+
+# Declared types of the occurrence columns. Fields with few distinct values are read as categoricals (stored once per value
+# instead of once per row) and the GBIF keys as integers; all other columns are read as text.
+# The keys are parsed as text and converted afterwards, so a value that is not an integer only empties that value.
+categorical_columns = ["datasetKey", "kingdom", "phylum", "class", "order", "family", "genus", "infraspecificEpithet",
+                       "taxonRank", "publishingOrgKey", "basisOfRecord", "institutionCode", "collectionCode"]
+integer_columns = ["gbifID", "taxonKey", "speciesKey"]
+occurrence_dtypes = {
+    **{col: str for col in occurrence_columns},
+    **{col: "category" for col in categorical_columns},
+}
+
+# Number of lines parsed at a time when reading an occurrence file
+read_block_lines = 200000
+
+# Processing mode: 'in_memory' (default) combines all rows of a publisher in one DataFrame to find duplicates;
+# 'chunked' streams the rows twice and keeps only a 64-bit hash per row, so memory stays flat for the largest publisher
+processing_mode = (os.getenv("PROCESSING_MODE") or "in_memory").strip().lower()
+if processing_mode not in ("in_memory", "chunked"):
+    raise ValueError(f"Unknown PROCESSING_MODE '{processing_mode}', expected 'in_memory' or 'chunked'")
+
+# Dataset names are cached in the zip folder and looked up again after DATASET_NAME_MAX_AGE_DAYS (default 30).
+# With DATASET_NAMES_OFFLINE=true only the cached names are used and the GBIF registry is not contacted.
+dataset_name_cache_path = os.path.join(os.getenv("ZIP_FOLDER_PATH") or ".", "datasetNames.db")
+dataset_name_max_age = float(os.getenv("DATASET_NAME_MAX_AGE_DAYS") or 30) * 24 * 60 * 60
+dataset_names_offline = (os.getenv("DATASET_NAMES_OFFLINE") or "false").strip().lower() == "true"
+
+# Columns of the occurrence breakdown reports (occurrences and unique species for each value of each column)
+breakdown_columns = [col.strip() for col in (os.getenv("BREAKDOWN_COLUMNS") or "kingdom,class,family,basisOfRecord,collectionCode").split(",") if col.strip()]
+for col in breakdown_columns:
+    if col not in occurrence_columns:
+        raise ValueError(f"Unknown column '{col}' in BREAKDOWN_COLUMNS, expected one of the occurrence columns")
+
+# Number of publishers processed at the same time, each in its own process (default: the number of CPUs)
+max_workers = int(os.getenv("MAX_WORKERS") or os.cpu_count() or 1)
+
+# The occurrences of each report year are kept in a Parquet store (by default in the zip folder), to compare with earlier years.
+# Set UPDATE_OCCURRENCE_STORE=false to skip it.
+report_year = int(os.getenv("YEAR") or date.today().year)
+occurrence_store_path = os.getenv("OCCURRENCE_STORE_PATH") or os.path.join(os.getenv("ZIP_FOLDER_PATH") or ".", "occurrenceStore")
+update_store = (os.getenv("UPDATE_OCCURRENCE_STORE") or "true").strip().lower() != "false"
+
+# Parse a block of lines from a GBIF occurrence file, with the header line of the file.
+# Every block is checked for lines with more or fewer fields than the header, as the C parser would take the extra leading
+# fields of a long first line as an index and shift every row of the block. If all lines have the header's number of tabs,
+# the block is parsed with the fast C parser. Otherwise the fields of each line are counted exactly (with escaped tabs), and
+# the block is parsed with the python parser, which reads malformed lines like a single pass over the whole file does (long
+# lines are cut to the header's columns and short lines are padded). Returns (df, malformed lines).
+def parse_occurrence_block(header, lines, usecols):
+    # index_col=False: the first column is never taken as an index
+    options = dict(dtype=occurrence_dtypes, sep="\t", quoting=csv.QUOTE_NONE, escapechar="\\", usecols=usecols, index_col=False)
+    text = header + "".join(lines)
+    header_tabs = header.count("\t")
+    if all(line.count("\t") == header_tabs for line in lines):
+        try:
+            return pd.read_csv(io.StringIO(text), engine="c", on_bad_lines="error", **options), []
+        except pd.errors.ParserError:
+            pass
+
+    bad_lines = []
+    for line in lines:
+        fields = next(csv.reader([line], delimiter="\t", quoting=csv.QUOTE_NONE, escapechar="\\"), [])
+        # Empty lines are skipped by pandas
+        if fields and len(fields) != header_tabs + 1:
+            bad_lines.append(line)
+    with warnings.catch_warnings():
+        # The python parser warns about the cut long lines, which are counted as malformed lines instead
+        warnings.simplefilter("ignore", pd.errors.ParserWarning)
+        return pd.read_csv(io.StringIO(text), engine="python", **options), bad_lines
+
+# Convert the key columns of a parsed block from text to integers (Int64). Values that are not integers are left empty.
+# Returns the number of values that could not be converted.
+def convert_integer_columns(df):
+    bad_value_count = 0
+    for col in integer_columns:
+        if col not in df.columns:
             continue
-
-        # Initialize combined df
-        combined_df = pd.DataFrame()
-
-        # Process zip files by publisher
+        values = pd.to_numeric(df[col], errors="coerce", dtype_backend="numpy_nullable")
+        if not pd.api.types.is_integer_dtype(values):
+            # Numbers with decimals are not keys either
+            values = values.where(values % 1 == 0)
+        values = values.astype("Int64")
+        bad_value_count += int((df[col].notna() & values.isna()).sum())
+        df[col] = values
+    return bad_value_count
+
+# Read a tab-separated occurrence file straight from an open ZIP file, block by block.
+# Yields (df, number of bad lines, number of bad key values) per block.
+def iter_occurrence_blocks(z, csv_member, usecols):
+    with z.open(csv_member) as binary_file:
+        text_file = io.TextIOWrapper(binary_file, encoding="utf-8", errors="replace", newline="")
+        header = text_file.readline()
+        first_block = True
+        while True:
+            lines = list(itertools.islice(text_file, read_block_lines))
+            if not lines and not first_block:
+                return
+            df, bad_lines = parse_occurrence_block(header, lines, usecols)
+            bad_value_count = convert_integer_columns(df)
+            yield df, len(bad_lines), bad_value_count
+            first_block = False
+            if not lines:
+                return
+
+# Combine occurrence frames, keeping the categorical columns categorical (pd.concat turns categoricals with
+# different categories into text), so the categories are first set to the sorted union of all categories
+def concat_occurrence_frames(dfs):
+    dfs = list(dfs)
+    for col in categorical_columns:
+        if all(col in df.columns and isinstance(df[col].dtype, pd.CategoricalDtype) for df in dfs):
+            categories = pd.Index([]).append([df[col].cat.categories for df in dfs]).unique().sort_values()
+            dfs = [df.assign(**{col: df[col].cat.set_categories(categories)}) for df in dfs]
+    return pd.concat(dfs, ignore_index=True)
+
+# Read a whole occurrence file from an open ZIP file. Returns (df, number of bad lines, number of bad key values).
+def read_occurrence_csv(z, csv_member, usecols):
+    blocks = list(iter_occurrence_blocks(z, csv_member, usecols))
+    return (concat_occurrence_frames(df for df, _, _ in blocks), sum(count for _, count, _ in blocks),
+            sum(count for _, _, count in blocks))
+
+# Count the rows of each dataset, as a Series indexed by datasetKey (text) in sorted order.
+# Only datasets that have rows are counted, also when datasetKey is categorical.
+def count_by_dataset(df):
+    counts = df.groupby("datasetKey", observed=True).size()
+    counts.index = counts.index.astype(object)
+    return counts
+
+# The occurrence files in a ZIP file (top-level CSV files)
+def get_csv_members(z):
+    return [name for name in z.namelist() if name.endswith(".csv") and "/" not in name]
+
+# Rows with the same catalogNumber and scientificName are duplicates. Rows without a catalogNumber are never duplicates.
+duplicate_key_columns = ["catalogNumber", "scientificName"]
+
+def has_catalog_number(df):
+    return df["catalogNumber"].notnull() & (df["catalogNumber"] != "")
+
+# 64-bit hash of the duplicate key of every row
+def hash_duplicate_keys(df):
+    return pd.util.hash_pandas_object(df[duplicate_key_columns], index=False).to_numpy()
+
+# Append rows to a CSV file, writing the header only when the file is created
+def append_csv(df, path, header=True):
+    df.to_csv(path, mode="a", header=header and not os.path.exists(path), index=False)
+
+# Read the occurrence files of a publisher's ZIP files block by block, without ever holding a whole file in memory
+def iter_publisher_blocks(zip_files, report=False):
+    for zip_file in zip_files:
+        if report:
+            print(f"Processing ZIP file: {zip_file}")
+        with zipfile.ZipFile(zip_file, "r") as z:
+            for csv_member in get_csv_members(z):
+                if report:
+                    print(f"Reading CSV file: {csv_member}")
+                row_count = bad_line_count = bad_value_count = 0
+                for df, block_bad_line_count, block_bad_value_count in iter_occurrence_blocks(z, csv_member, occurrence_columns):
+                    row_count += len(df)
+                    bad_line_count += block_bad_line_count
+                    bad_value_count += block_bad_value_count
+                    yield df
+                if report:
+                    print("Rows read:", row_count)
+                    print("Bad rows:", bad_line_count)
+                    print("Bad key values:", bad_value_count)
+
+# Find the unique and duplicate rows of a publisher in two streaming passes over its ZIP files, so memory stays flat.
+# The first pass counts the rows by dataset and collects a 64-bit hash of the duplicate key of every row. The second pass
+# uses the counts of each hash to write the unique rows (first occurrence of each key, then the rows without a catalogNumber)
+# and the duplicate rows (every row whose key occurs more than once) to the publisher's CSV files as it goes, and appends
+# the duplicate rows (with a publisher column) to duplicates_part_file.
+# The first pass also adds up the partial counts of the breakdown reports, and adds the rows to the occurrence store update.
+# Returns (rows by dataset, duplicate rows by dataset, total rows, total duplicate rows, key counts, breakdown counts),
+# matching the in-memory mode.
+def find_duplicates_chunked(publisher_name, zip_files, output_folder, duplicates_part_file, store_update=None):
+    dataset_counts = []
+    key_hashes = []
+    total_rows = 0
+    breakdown = None
+    for df in iter_publisher_blocks(zip_files, report=True):
+        total_rows += len(df)
+        write_store_block(store_update, df)
+        breakdown = combine_breakdowns([breakdown, partial_breakdown(df, breakdown_columns)], breakdown_columns)
+        dataset_counts.append(count_by_dataset(df))
+        key_hashes.append(hash_duplicate_keys(df[has_catalog_number(df)]))
+
+    unique_hashes, hash_counts = count_key_hashes(np.concatenate(key_hashes) if key_hashes else [])
+    del key_hashes
+    seen = np.zeros(len(unique_hashes), dtype=bool)
+
+    unique_file = f"{output_folder}/{publisher_name}_unique_catalogNumbers.csv"
+    publisher_duplicates_file = f"{output_folder}/{publisher_name}_duplicate_catalogNumbers.csv"
+    # Rows without a catalogNumber go at the end of the unique file, so they are collected in a temporary file first
+    no_catalog_number_file = f"{unique_file}.part"
+    for path in (unique_file, publisher_duplicates_file, no_catalog_number_file):
+        if os.path.exists(path):
+            os.remove(path)
+
+    duplicate_counts = []
+    total_duplicates = 0
+    for df in iter_publisher_blocks(zip_files):
+        has_id = has_catalog_number(df)
+        non_null_ids = df[has_id]
+        positions = np.searchsorted(unique_hashes, hash_duplicate_keys(non_null_ids))
+
+        # First occurrence of a key: not seen in an earlier block, and not earlier in this block
+        first_occurrence = ~seen[positions] & ~pd.Series(positions).duplicated().to_numpy()
+        seen[positions] = True
+        append_csv(non_null_ids[first_occurrence], unique_file)
+        append_csv(df[~has_id], no_catalog_number_file, header=False)
+
+        duplicates = non_null_ids[hash_counts[positions] > 1]
+        if not duplicates.empty:
+            append_csv(duplicates, publisher_duplicates_file)
+            append_csv(duplicates.assign(publisher=publisher_name), duplicates_part_file)
+            duplicate_counts.append(count_by_dataset(duplicates))
+            total_duplicates += len(duplicates)
+
+    # Both files were written by pandas as UTF-8, so they are joined as bytes
+    with open(unique_file, "ab") as unique, open(no_catalog_number_file, "rb") as no_catalog_number:
+        shutil.copyfileobj(no_catalog_number, unique)
+    os.remove(no_catalog_number_file)
+
+    print(f"Unique catalogNumbers for {publisher_name} saved: {unique_file}")
+    if total_duplicates:
+        print(f"Duplicate catalogNumbers for {publisher_name} saved: {publisher_duplicates_file}")
+    else:
+        print(f"No duplicates found for {publisher_name}, skipping publisher assignment.")
+
+    def sum_counts(counts):
+        if not counts:
+            return pd.Series(dtype=int)
+        return pd.concat(counts).groupby(level=0).sum()
+
+    return (sum_counts(dataset_counts), sum_counts(duplicate_counts), total_rows, total_duplicates, (unique_hashes, hash_counts),
+            breakdown)
+
+# Process the zip files of one publisher: write its unique and duplicate rows to the CSV files in the folder of its zip
+# files and its duplicates (with a publisher column) to duplicates_part_file, and update the occurrence store.
+# Runs in a worker process, so it only returns the small summaries: (rows by dataset, duplicate rows by dataset,
+# publisher summary, key counts, breakdown counts), or None if the publisher has no zip files.
+def process_publisher(publisher, zip_folder_path, duplicates_part_file):
+    publisher_name = publisher["name"]
+    print(f"\nProcessing publisher: {publisher_name}")
+
+    # Group zip files by publisher
+    zip_files = glob.glob(os.path.join(zip_folder_path, f"{publisher_name.replace(' ', '_')}_*.zip"))
+    if not zip_files:
+        print(f"No ZIP files found for publisher: {publisher_name}")
+        return None
+
+    # Output files for the publisher are saved in the folder named after the (last) zip file
+    for zip_file in zip_files:
+        output_folder = os.path.splitext(zip_file)[0]
+        os.makedirs(output_folder, exist_ok=True)
+
+    # Add the publisher's occurrences to the occurrence store while they are read, if these zip files are not in the store yet
+    store_update = start_store_update(occurrence_store_path, report_year, publisher_name, zip_files) if update_store else None
+
+    if processing_mode == "chunked":
+        (
+            dataset_totals, duplicate_totals, total_preserved_specimens, total_duplicates, key_counts, breakdown
+        ) = find_duplicates_chunked(publisher_name, zip_files, output_folder, duplicates_part_file, store_update)
+        print(f"Number of duplicate rows for {publisher_name}: {total_duplicates}")
+
+        dataset_counts = dataset_totals.rename_axis("datasetKey").reset_index(name="totalOccurrences")
+        duplicate_counts = duplicate_totals.rename_axis("datasetKey").reset_index(name="duplicatesCountedInOtherDatasets")
+    else:
+        # Read all zip files of the publisher, and combine them once
+        dfs = []
         for zip_file in zip_files:
             print(f"Processing ZIP file: {zip_file}")
-            output_folder = os.path.splitext(zip_file)[0]
             with zipfile.ZipFile(zip_file, "r") as z:
-                z.extractall(output_folder)
-
-            csv_files = glob.glob(os.path.join(output_folder, "*.csv"))
-            for csv_file in csv_files:
-                print(f"Reading CSV file: {csv_file}")
-                
-                bad_lines = []
-
-                def bad_line_handler(line):
-                    bad_lines.append(line)
-                    return None
-
-                df = pd.read_csv(
-                    csv_file,
-                    dtype=str,
-                    sep="\t",
-                    engine="python",
-                    on_bad_lines=bad_line_handler,
-                    quoting=csv.QUOTE_NONE,
-                    escapechar="\\",
-                    encoding_errors="replace",
-                    usecols=["gbifID", "datasetKey", "occurrenceID", "kingdom", "phylum", "class", "order", "family", "genus",
-                             "species", "infraspecificEpithet", "taxonRank", "scientificName", "publishingOrgKey",
-                             "eventDate", "taxonKey", "speciesKey", "basisOfRecord", "institutionCode", "collectionCode",
-                             "catalogNumber", "lastInterpreted"]
-                )
-
-                print("Rows read:", len(df))
-                print("Bad rows:", len(bad_lines))
-
-                combined_df = pd.concat([combined_df, df], ignore_index=True)
+                # Read the CSV files straight from the ZIP file, without extracting them
+                for csv_member in get_csv_members(z):
+                    print(f"Reading CSV file: {csv_member}")
+                    df, bad_line_count, bad_value_count = read_occurrence_csv(z, csv_member, occurrence_columns)
+
+                    print("Rows read:", len(df))
+                    print("Bad rows:", bad_line_count)
+                    print("Bad key values:", bad_value_count)
+
+                    write_store_block(store_update, df)
+                    dfs.append(df)
+        combined_df = concat_occurrence_frames(dfs) if dfs else pd.DataFrame()
 
         # Create group of rows where catalogNumber is null or empty
-        blank_or_null_ids = combined_df[combined_df["catalogNumber"].isnull() | (combined_df["catalogNumber"] == "")]
+        blank_or_null_ids = combined_df[~has_catalog_number(combined_df)]
         # Remove duplicates from df where catalogNumber is not null or empty
-        non_null_ids = combined_df[combined_df["catalogNumber"].notnull() & (combined_df["catalogNumber"] != "")]
+        non_null_ids = combined_df[has_catalog_number(combined_df)]
         unique_non_null_ids = non_null_ids.drop_duplicates(
-            subset=["catalogNumber", "scientificName"], 
+            subset=duplicate_key_columns,
             keep="first"
             )
         # Add rows with null or empty catalogNumber back to df after duplicates have been removed
@@ -94,37 +329,109 @@ def process_existing_zip_files(publishers, zip_folder_path):
         print(f"Unique catalogNumbers for {publisher_name} saved: {output_folder}/{publisher_name}_unique_catalogNumbers.csv")
 
         # Create duplicates df
-        duplicates = non_null_ids[non_null_ids.duplicated(subset=["catalogNumber", "scientificName"], keep=False)]
-        # Add duplicates to all_duplicates df
+        duplicates = non_null_ids[non_null_ids.duplicated(subset=duplicate_key_columns, keep=False)]
+        # Save duplicates for the all-publishers duplicates file
         if not duplicates.empty:
             duplicates = duplicates.copy()
             duplicates.to_csv(f"{output_folder}/{publisher_name}_duplicate_catalogNumbers.csv", index=False)
             print(f"Duplicate catalogNumbers for {publisher_name} saved: {output_folder}/{publisher_name}_duplicate_catalogNumbers.csv")
             duplicates.loc[:, "publisher"] = publisher_name
-            all_duplicates = pd.concat([all_duplicates, duplicates], ignore_index=True)
+            duplicates.to_csv(duplicates_part_file, index=False)
         else:
             print(f"No duplicates found for {publisher_name}, skipping publisher assignment.")
 
         # Print number of duplicate rows
-        print(f"Number of duplicate rows: {len(all_duplicates)}")
+        print(f"Number of duplicate rows for {publisher_name}: {len(duplicates)}")
 
         # Create dataset_counts df by grouping rows by datasetKey
-        dataset_counts = (
-            combined_df.groupby("datasetKey")
-            .size()
-            .reset_index(name="totalOccurrences")
+        dataset_counts = count_by_dataset(combined_df).rename_axis("datasetKey").reset_index(name="totalOccurrences")
+        # Get count of duplicates by dataset
+        duplicate_counts = (
+            count_by_dataset(duplicates).rename_axis("datasetKey").reset_index(name="duplicatesCountedInOtherDatasets")
         )
-        dataset_counts["publisher"] = publisher_name
+
+        # Get total counts for pulisher level summary
+        total_preserved_specimens = len(combined_df)
+        total_duplicates = len(duplicates)
+        key_counts = count_key_hashes(hash_duplicate_keys(non_null_ids))
+        breakdown = partial_breakdown(combined_df, breakdown_columns) if len(combined_df) else None
+
+    finish_store_update(store_update)
+    dataset_counts["publisher"] = publisher_name
+
+    unique_preserved_specimens = total_preserved_specimens - total_duplicates
+
+    # Create publisher level summary
+    summary = pd.DataFrame(
+        [{
+            "publisher": publisher_name, 
+            "totalOccurrences": total_preserved_specimens,
+            "duplicatesCountedInOtherDatasets": total_duplicates,
+            "uniqueOccurrences": unique_preserved_specimens
+        }]
+    )
+
+    return dataset_counts, duplicate_counts, summary, key_counts, breakdown
+
+# Join the duplicates part files of the publishers (in publisher order) into one CSV file, and remove them
+def join_duplicates_part_files(duplicates_part_files, duplicates_file):
+    duplicates_part_files = [part_file for part_file in duplicates_part_files if os.path.exists(part_file)]
+    if not duplicates_part_files:
+        pd.DataFrame().to_csv(duplicates_file, index=False)
+        return
+
+    # The part files were written by pandas as UTF-8, so they are joined as bytes
+    with open(duplicates_file, "wb") as duplicates:
+        for i, part_file in enumerate(duplicates_part_files):
+            with open(part_file, "rb") as part:
+                # Keep the header of the first file only
+                header = part.readline()
+                if i == 0:
+                    duplicates.write(header)
+                shutil.copyfileobj(part, duplicates)
+            os.remove(part_file)
+
+def process_existing_zip_files(publishers, zip_folder_path):
+    all_dataset_counts = pd.DataFrame()
+    all_summaries = pd.DataFrame()
+    # Keys of all publishers, to find duplicates across the publishers of an institution
+    key_index = {}
+    # Partial counts of the breakdown reports of each publisher
+    publisher_breakdowns = []
+
+    output_folder_path = os.getenv("OUTPUT_FOLDER_PATH")
+    os.makedirs(output_folder_path, exist_ok=True)
+    duplicates_file = os.path.join(output_folder_path, "duplicate_occurrences.csv")
+    # Each publisher writes its duplicates to its own part file, which are joined at the end
+    duplicates_part_files = [f"{duplicates_file}.{i}.part" for i in range(len(publishers))]
+    for part_file in duplicates_part_files:
+        if os.path.exists(part_file):
+            os.remove(part_file)
+
+    # The publishers are processed in parallel, each in its own process
+    workers = min(max_workers, len(publishers))
+    if workers <= 1:
+        results = list(map(process_publisher, publishers, itertools.repeat(zip_folder_path), duplicates_part_files))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(process_publisher, publishers, itertools.repeat(zip_folder_path), duplicates_part_files))
+
+    # Look up the names of the datasets of all publishers at once, each unique datasetKey only once
+    dataset_names = resolve_dataset_names(
+        {key for result in results if result is not None for key in result[0]["datasetKey"]},
+        dataset_name_cache_path, dataset_name_max_age, offline=dataset_names_offline
+    )
+
+    # Merge the summaries of the publishers, in publisher order
+    for publisher, result in zip(publishers, results):
+        if result is None:
+            continue
+        dataset_counts, duplicate_counts, summary, key_counts, breakdown = result
+        publisher_name = publisher["name"]
 
         # Add dataset_counts df to combined dataset summary
         all_dataset_counts = pd.concat([all_dataset_counts, dataset_counts], ignore_index=True)
-        all_dataset_counts["datasetName"] = all_dataset_counts["datasetKey"].apply(get_dataset_name)
-        # Get count of duplicates by dataset
-        duplicate_counts = (
-            duplicates.groupby("datasetKey")
-            .size()
-            .reset_index(name="duplicatesCountedInOtherDatasets")
-        )
+        all_dataset_counts["datasetName"] = all_dataset_counts["datasetKey"].map(dataset_names).fillna("Unknown Dataset")
 
         # Ensure datasetKey exists before merging
         if "datasetKey" not in all_dataset_counts.columns:
@@ -163,49 +470,57 @@ def process_existing_zip_files(publishers, zip_folder_path):
         all_dataset_counts["uniqueOccurrences"] = all_dataset_counts["uniqueOccurrences"].fillna(0).astype(int)
         all_dataset_counts["totalOccurrences"] = all_dataset_counts["totalOccurrences"].fillna(0).astype(int)
 
-        # Get total counts for pulisher level summary
-        total_preserved_specimens = len(combined_df)
-        total_duplicates = len(duplicates)
-        unique_preserved_specimens = total_preserved_specimens - total_duplicates
-
-        # Create publisher level summary
-        summary = pd.DataFrame(
-            [{
-                "publisher": publisher_name, 
-                "totalOccurrences": total_preserved_specimens,
-                "duplicatesCountedInOtherDatasets": total_duplicates,
-                "uniqueOccurrences": unique_preserved_specimens
-            }]
-        )
-
         # Add publisher level summary to combined publisher level summary
         all_summaries = pd.concat([all_summaries, summary], ignore_index=True)
 
-    # Save all dfs to output_folder
-    output_folder_path = os.getenv("OUTPUT_FOLDER_PATH")
-    os.makedirs(output_folder_path, exist_ok=True)
+        add_publisher(key_index, publisher_name, publisher.get("institution", publisher_name), key_counts,
+                      int(summary["totalOccurrences"].iloc[0]))
+        publisher_breakdowns.append((publisher_name, breakdown))
 
+    # Save all dfs to output_folder
     dataset_counts_file = os.path.join(output_folder_path, "all_publishers_dataset_counts.csv")
     summary_file = os.path.join(output_folder_path, "all_publishers_summary.csv")
-    duplicates_file = os.path.join(output_folder_path, "duplicate_occurrences.csv")
 
     all_dataset_counts.to_csv(dataset_counts_file, index=False)
     all_summaries.to_csv(summary_file, index=False)
-    all_duplicates.to_csv(duplicates_file, index=False)
+    # The duplicates are not kept in memory, only in the CSV file
+    join_duplicates_part_files(duplicates_part_files, duplicates_file)
 
     print(f"\nConsolidated dataset counts saved: {dataset_counts_file}")
     print(f"Publisher-level summary saved: {summary_file}")
     print(f"Duplicate occurrences saved: {duplicates_file}")
 
-    return all_dataset_counts, all_summaries, all_duplicates
+    # Save the duplicates across publishers: the keys each pair of publishers share, and the counts for each institution
+    overlaps_file = os.path.join(output_folder_path, "publisher_overlaps.csv")
+    institution_summary_file = os.path.join(output_folder_path, "institution_summary.csv")
+    publisher_overlaps(key_index).to_csv(overlaps_file, index=False)
+    institution_summary(key_index).to_csv(institution_summary_file, index=False)
+    print(f"Publisher overlaps saved: {overlaps_file}")
+    print(f"Institution-level summary saved: {institution_summary_file}")
+
+    # Save the breakdown reports, one file for each column
+    for column, breakdown in breakdown_report(publisher_breakdowns, breakdown_columns).items():
+        breakdown_file = os.path.join(output_folder_path, f"breakdown_by_{column}.csv")
+        breakdown.to_csv(breakdown_file, index=False)
+        print(f"Breakdown by {column} saved: {breakdown_file}")
+
+    # Compare the dataset counts with the previous report year in the occurrence store
+    if update_store and store_available:
+        growth_file = os.path.join(output_folder_path, "dataset_growth.csv")
+        dataset_growth(occurrence_store_path, report_year).to_csv(growth_file, index=False)
+        print(f"Dataset growth since {report_year - 1} saved: {growth_file}")
+
+    return all_dataset_counts, all_summaries
     
+# List of publisher UUIDs and names. Publishers with the same institution are also counted together in institution_summary.csv
 publishers = [
-    {"uuid": "2e7df380-8356-4533-bcb3-5459e23c794e", "name": "Natural History Museum of Denmark"},
-    {"uuid": "ba482b53-07ed-4ca4-8981-5396d1a8a6fc", "name": "Botanical Garden & Museum, Natural History Museum of Denmark"},
+    {"uuid": "2e7df380-8356-4533-bcb3-5459e23c794e", "name": "Natural History Museum of Denmark", "institution": "Natural History Museum of Denmark"},
+    {"uuid": "ba482b53-07ed-4ca4-8981-5396d1a8a6fc", "name": "Botanical Garden & Museum, Natural History Museum of Denmark", "institution": "Natural History Museum of Denmark"},
     {"uuid": "760d5f24-4c04-40da-9646-1b2c935da502", "name": "Natural History Museum Aarhus"},
     {"uuid": "8e1a97a0-3ca8-11d9-8439-b8a03c50a862", "name": "Herbarium of the University of Aarhus"}
 ]
 
-zip_folder_path = os.getenv("ZIP_FOLDER_PATH")
+if __name__ == "__main__":
+    zip_folder_path = os.getenv("ZIP_FOLDER_PATH")
 
-all_dataset_counts, all_summaries, all_duplicates = process_existing_zip_files(publishers, zip_folder_path)
\ No newline at end of file
+    all_dataset_counts, all_summaries = process_existing_zip_files(publishers, zip_folder_path)
\ No newline at end of file
@@ -0,0 +1,208 @@
+# Persistent store of the occurrences processed by occurrenceProcessing.py, so that a report can be compared with earlier years
+# without downloading or processing the old zip files again.
+# The occurrences are saved as Parquet files partitioned by report year, publisher and dataset:
+#   <store>/year=2025/publisher=<publisher name>/datasetKey=<datasetKey>/part-0.parquet
+# Each publisher and year is written once per download, from the blocks of occurrences read while the download is
+# processed: _manifest.db records the zip files (with their sha256) that the partition was built from, and the partition
+# is only rewritten when those change.
+# The queries below only read the partitions and columns they need: occurrence counts come from the Parquet metadata, and
+# filters on year and publisher skip the other partitions.
+# If pyarrow is not installed, the store is not updated and the queries are not available.
+
+import os
+import shutil
+import sqlite3
+from urllib.parse import quote
+import pandas as pd
+from downloadRegistry import file_sha256
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+store_available = pa is not None
+
+# Open (and create if needed) the manifest of the store
+def open_manifest(store_path):
+    os.makedirs(store_path, exist_ok=True)
+    # Publishers are written by parallel processes, so wait for the other writers instead of failing
+    conn = sqlite3.connect(os.path.join(store_path, "_manifest.db"), timeout=60)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS zip_files (
+            year INTEGER NOT NULL,
+            publisher TEXT NOT NULL,
+            zip_file TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            mtime REAL NOT NULL,
+            sha256 TEXT NOT NULL,
+            PRIMARY KEY (year, publisher, zip_file)
+        )
+    """)
+    return conn
+
+# Get the content hash of a zip file. The hash is reused if the file has the same size and mtime as when it was stored.
+def get_zip_hash(conn, zip_file):
+    stat = os.stat(zip_file)
+    row = conn.execute(
+        "SELECT sha256 FROM zip_files WHERE zip_file = ? AND size = ? AND mtime = ?",
+        (os.path.abspath(zip_file), stat.st_size, stat.st_mtime)
+    ).fetchone()
+    return row[0] if row else file_sha256(zip_file)
+
+# Folder of a publisher's partition for a year. Folder names are URI-encoded, as pyarrow decodes them when reading.
+def get_publisher_folder(store_path, year, publisher_name):
+    return os.path.join(store_path, f"year={year}", f"publisher={quote(publisher_name, safe='')}")
+
+# Start updating a publisher's occurrences for a report year, unless the store already holds exactly these zip files.
+# The occurrences are then added block by block with write_store_block while the zip files are processed (so they are not
+# read again for the store), and finish_store_update swaps in the new partition.
+# Returns the state of the update, or None if there is nothing to do.
+def start_store_update(store_path, year, publisher_name, zip_files):
+    if not store_available:
+        print("pyarrow is not installed, the occurrence store is not updated")
+        return None
+
+    conn = open_manifest(store_path)
+    try:
+        stored_hashes = dict(conn.execute(
+            "SELECT zip_file, sha256 FROM zip_files WHERE year = ? AND publisher = ?", (year, publisher_name)
+        ).fetchall())
+        zip_hashes = {os.path.abspath(zip_file): get_zip_hash(conn, zip_file) for zip_file in zip_files}
+    finally:
+        conn.close()
+
+    publisher_folder = get_publisher_folder(store_path, year, publisher_name)
+    if zip_hashes == stored_hashes and os.path.isdir(publisher_folder):
+        print(f"Occurrence store is up to date for {publisher_name} ({year})")
+        return None
+
+    # The partition is written to a temporary folder (ignored by readers, as its name starts with a dot). A folder left
+    # by an earlier run that stopped is removed first; each publisher has its own, so parallel publishers do not clash.
+    temp_folder = os.path.join(os.path.dirname(publisher_folder), f".{os.path.basename(publisher_folder)}.tmp")
+    if os.path.exists(temp_folder):
+        shutil.rmtree(temp_folder)
+    os.makedirs(temp_folder)
+
+    return {
+        "store_path": store_path,
+        "year": year,
+        "publisher_name": publisher_name,
+        "zip_hashes": zip_hashes,
+        "publisher_folder": publisher_folder,
+        "temp_folder": temp_folder,
+        "schema": None,
+        "writers": {},
+    }
+
+# Add a block of occurrences to the update, writing each dataset's rows to the Parquet file of its datasetKey partition
+def write_store_block(update, df):
+    if update is None or df.empty:
+        return
+    # Categoricals are stored as plain text
+    df = df.astype({col: object for col in df.columns if isinstance(df[col].dtype, pd.CategoricalDtype)})
+    if update["schema"] is None:
+        # Integer columns are stored as int64 and all other columns as text
+        update["schema"] = pa.schema([
+            (col, pa.int64() if pd.api.types.is_integer_dtype(dtype) else pa.string())
+            for col, dtype in df.dtypes.items() if col != "datasetKey"
+        ])
+
+    for dataset_key, rows in df.groupby("datasetKey", dropna=False, sort=False):
+        # Rows without a datasetKey go to the partition pyarrow reads as null
+        dataset_key = None if pd.isna(dataset_key) else dataset_key
+        writer = update["writers"].get(dataset_key)
+        if writer is None:
+            folder_name = "__HIVE_DEFAULT_PARTITION__" if dataset_key is None else quote(dataset_key, safe="")
+            dataset_folder = os.path.join(update["temp_folder"], f"datasetKey={folder_name}")
+            os.makedirs(dataset_folder)
+            writer = pq.ParquetWriter(os.path.join(dataset_folder, "part-0.parquet"), update["schema"])
+            update["writers"][dataset_key] = writer
+        writer.write_table(pa.Table.from_pandas(rows.drop(columns="datasetKey"), schema=update["schema"], preserve_index=False))
+
+# Finish an update: close the Parquet files, swap the new partition with the old one and record the zip files in the manifest
+def finish_store_update(update):
+    if update is None:
+        return
+    for writer in update["writers"].values():
+        writer.close()
+
+    if os.path.exists(update["publisher_folder"]):
+        shutil.rmtree(update["publisher_folder"])
+    os.replace(update["temp_folder"], update["publisher_folder"])
+
+    year, publisher_name = update["year"], update["publisher_name"]
+    conn = open_manifest(update["store_path"])
+    try:
+        with conn:
+            conn.execute("DELETE FROM zip_files WHERE year = ? AND publisher = ?", (year, publisher_name))
+            conn.executemany(
+                "INSERT INTO zip_files (year, publisher, zip_file, size, mtime, sha256) VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (year, publisher_name, zip_file, os.stat(zip_file).st_size, os.stat(zip_file).st_mtime, sha256)
+                    for zip_file, sha256 in update["zip_hashes"].items()
+                ]
+            )
+    finally:
+        conn.close()
+    print(f"Occurrence store updated for {publisher_name} ({year})")
+
+# Open the store as a pyarrow dataset, with year, publisher and datasetKey as columns taken from the folder names
+def open_occurrence_store(store_path):
+    partitioning = ds.partitioning(
+        pa.schema([("year", pa.int32()), ("publisher", pa.string()), ("datasetKey", pa.string())]), flavor="hive"
+    )
+    return ds.dataset(store_path, format="parquet", partitioning=partitioning)
+
+# Build a filter on the partition columns
+def partition_filter(year, publisher_name=None):
+    expression = ds.field("year") == year
+    if publisher_name is not None:
+        expression = expression & (ds.field("publisher") == publisher_name)
+    return expression
+
+# Count the occurrences of each year, publisher and dataset in the store, from the Parquet metadata only
+def count_occurrences(store_path):
+    rows = []
+    for fragment in open_occurrence_store(store_path).get_fragments():
+        rows.append({**ds.get_partition_keys(fragment.partition_expression), "occurrences": fragment.count_rows()})
+    if not rows:
+        return pd.DataFrame(columns=["year", "publisher", "datasetKey", "occurrences"])
+    return pd.DataFrame(rows).groupby(["year", "publisher", "datasetKey"], as_index=False, dropna=False)["occurrences"].sum()
+
+# Compare the occurrence count of each dataset with the previous report year.
+# Datasets that are new or no longer published have 0 occurrences in the year they are missing.
+def dataset_growth(store_path, year):
+    counts = count_occurrences(store_path)
+    current = counts[counts["year"] == year].drop(columns="year")
+    previous = counts[counts["year"] == year - 1].drop(columns="year")
+    growth = current.merge(previous, on=["publisher", "datasetKey"], how="outer", suffixes=("", "PreviousYear"))
+    growth = growth.fillna({"occurrences": 0, "occurrencesPreviousYear": 0})
+    growth["occurrences"] = growth["occurrences"].astype(int)
+    growth["occurrencesPreviousYear"] = growth["occurrencesPreviousYear"].astype(int)
+    growth["growth"] = growth["occurrences"] - growth["occurrencesPreviousYear"]
+    return growth.sort_values(["publisher", "datasetKey"], ignore_index=True)
+
+# Get the occurrences of a report year whose gbifID was not in the previous report year (optionally for one publisher)
+def new_since_last_year(store_path, year, publisher_name=None, columns=None):
+    store = open_occurrence_store(store_path)
+    previous_ids = store.to_table(columns=["gbifID"], filter=partition_filter(year - 1, publisher_name)).column("gbifID")
+    new_filter = partition_filter(year, publisher_name) & ~ds.field("gbifID").isin(previous_ids)
+    return store.to_table(columns=columns, filter=new_filter).to_pandas()
+
+# Get the occurrences of a report year that were in the previous report year but have been interpreted again by GBIF since
+# (a later lastInterpreted), e.g. because the record was updated by the publisher (optionally for one publisher)
+def reinterpreted_since_last_year(store_path, year, publisher_name=None, columns=None):
+    store = open_occurrence_store(store_path)
+    previous = store.to_table(
+        columns=["gbifID", "lastInterpreted"], filter=partition_filter(year - 1, publisher_name)
+    ).to_pandas()
+    current = store.to_table(columns=columns, filter=partition_filter(year, publisher_name)).to_pandas()
+    merged = current.merge(previous, on="gbifID", how="inner", suffixes=("", "PreviousYear"))
+    later = (
+        pd.to_datetime(merged["lastInterpreted"], utc=True, errors="coerce")
+        > pd.to_datetime(merged["lastInterpretedPreviousYear"], utc=True, errors="coerce")
+    )
+    return merged[later].reset_index(drop=True)
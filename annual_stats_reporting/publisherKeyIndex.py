@@ -0,0 +1,63 @@
+# Index of the duplicate keys (catalogNumber and scientificName) of all publishers, used by occurrenceProcessing.py to find
+# occurrences that are published by more than one publisher of the same institution, e.g. the Natural History Museum of Denmark
+# publishes both as "Natural History Museum of Denmark" and as "Botanical Garden & Museum, Natural History Museum of Denmark".
+# For each publisher the index only keeps the sorted 64-bit hashes of its keys and the number of rows with each key
+# (16 bytes per distinct key), which are collected while the publisher's rows are processed, so the publishers' rows never
+# have to be in memory together and the zip files are not read again.
+
+import itertools
+import numpy as np
+import pandas as pd
+
+# Count the rows of each key hash. Returns (sorted unique hashes, number of rows with each hash).
+def count_key_hashes(key_hashes):
+    return np.unique(np.asarray(key_hashes, dtype=np.uint64), return_counts=True)
+
+# Add a publisher to the index. total_rows includes the rows without a catalogNumber (which are never duplicates).
+def add_publisher(key_index, publisher_name, institution, key_counts, total_rows):
+    key_index[publisher_name] = {"institution": institution, "key_counts": key_counts, "total_rows": total_rows}
+
+# Count the keys shared by each pair of publishers, and the rows each of them has with those keys
+def publisher_overlaps(key_index):
+    rows = []
+    for publisher_a, publisher_b in itertools.combinations(key_index, 2):
+        hashes_a, counts_a = key_index[publisher_a]["key_counts"]
+        hashes_b, counts_b = key_index[publisher_b]["key_counts"]
+        _, positions_a, positions_b = np.intersect1d(hashes_a, hashes_b, assume_unique=True, return_indices=True)
+        rows.append({
+            "publisherA": publisher_a,
+            "publisherB": publisher_b,
+            "institutionA": key_index[publisher_a]["institution"],
+            "institutionB": key_index[publisher_b]["institution"],
+            "sharedKeys": len(positions_a),
+            "sharedOccurrencesA": int(counts_a[positions_a].sum()),
+            "sharedOccurrencesB": int(counts_b[positions_b].sum()),
+        })
+    return pd.DataFrame(rows, columns=["publisherA", "publisherB", "institutionA", "institutionB", "sharedKeys",
+                                       "sharedOccurrencesA", "sharedOccurrencesB"])
+
+# Summarize each institution over all its publishers, with the same counts as the publisher-level summary: rows whose key
+# occurs more than once in any of the institution's publishers are duplicates, all other rows are unique.
+def institution_summary(key_index):
+    rows = []
+    institutions = dict.fromkeys(entry["institution"] for entry in key_index.values())
+    for institution in institutions:
+        publishers = [name for name, entry in key_index.items() if entry["institution"] == institution]
+        hashes = np.concatenate([key_index[name]["key_counts"][0] for name in publishers])
+        counts = np.concatenate([key_index[name]["key_counts"][1] for name in publishers])
+        # Add up the rows of each key over the publishers
+        _, key_positions = np.unique(hashes, return_inverse=True)
+        key_totals = np.bincount(key_positions, weights=counts).astype(np.int64)
+
+        total_rows = sum(key_index[name]["total_rows"] for name in publishers)
+        duplicates = int(key_totals[key_totals > 1].sum())
+        rows.append({
+            "institution": institution,
+            "publishers": "; ".join(publishers),
+            "totalOccurrences": total_rows,
+            "duplicatesCountedInOtherDatasets": duplicates,
+            "uniqueOccurrences": total_rows - duplicates,
+            "distinctKeys": len(key_totals),
+        })
+    return pd.DataFrame(rows, columns=["institution", "publishers", "totalOccurrences", "duplicatesCountedInOtherDatasets",
+                                       "uniqueOccurrences", "distinctKeys"])
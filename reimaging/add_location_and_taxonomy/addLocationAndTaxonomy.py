@@ -1,15 +1,22 @@
 # This script takes the list of specimens to be re-imaged from the QA_Images_Issues.xlsx file and searches for the corresponding barcode in the DigiApp exports.
 # It also searches for missing barcodes in the SQLite databases for each workstation.
 # It extracts the taxonfullname, storagefullname, and storagename columns from the DigiApp exports and writes them to a new sheet in the same Excel file.
+# Finally, it fills in the Status column on the Specimens tab (see updateReimagingStatus.py).
+# The sheets are parsed from one read of the workbook, which is loaded again with openpyxl to save it once (see qaWorkbook.py).
 
 import pandas as pd
 import os
-import glob
-import sqlite3
+import sys
 from openpyxl import load_workbook
 from datetime import datetime
 from dotenv import load_dotenv
 
+# Shared helpers for the DigiApp exports and barcode-guid matching databases are kept in the reimaging folder
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from digiAppArchive import lookup_export_records, open_catalog, refresh_record_index
+from jpgsDatabases import connect_with_cache, default_cache_path, lookup_guid_rows, map_databases, refresh_guid_index, source_has_index_on
+from qaWorkbook import merge_reimage_sheet, read_qa_workbook, write_qa_workbook
+
 # Load environment variables from the .env file
 load_dotenv()
 
@@ -18,192 +25,218 @@ file_path = os.getenv("FILE_PATH")
 base_directory = os.getenv("BASE_DIRECTORY")  
 db_directory = os.getenv("DB_DIRECTORY")
 
+# Folder for the export catalog and other derived cache databases (optional, defaults to reimaging/cache)
+cache_path = os.getenv("CACHE_PATH") or default_cache_path
+
+# Connections to the workstation databases (with their derived cache), opened once per process and reused for every workbook
+db_connections = {}
+
+workstation_collections = {
+    'WORKHERB0001': 'NHMD_Herbarium',
+    'WORKHERB0002': 'AU_Herbarium',
+    'WORKHERB0003': 'NHMD_Herbarium',
+    'WORKPIOF0001': 'NHMD_PinnedInsects',
+    'WORKPIOF0002': 'NHMD_PinnedInsects',
+    'WORKPIOF0003': 'NHMA_PinnedInsects'
+}
+
 def get_collection(workstation):
-    mapping = {
-        'WORKHERB0001': 'NHMD_Herbarium',
-        'WORKHERB0002': 'AU_Herbarium',
-        'WORKHERB0003': 'NHMD_Herbarium',
-        'WORKPIOF0001': 'NHMD_PinnedInsects',
-        'WORKPIOF0002': 'NHMD_PinnedInsects',
-        'WORKPIOF0003': 'NHMA_PinnedInsects'
-    }
-    return mapping.get(workstation, None)
-
-# Pull the taxonomy and storage information from the DigiApp exports based on the barcode
-def search_barcode_in_csv(barcode, directory):
-    if not barcode or barcode.upper() == 'NA':
-        return None
-    
+    return workstation_collections.get(workstation, None)
+
+def get_db_connection(db_path):
+    if db_path not in db_connections:
+        # A database can be queried from different threads of map_databases, but never from two at the same time
+        db_connections[db_path] = connect_with_cache(db_path, cache_path, check_same_thread=False)
+    return db_connections[db_path]
+
+# Bring the archive index of every collection and the GUID index of every workstation database up to date.
+# Used before processing several workbooks at once, so that they all share the same indexes and none of them has to update them.
+def refresh_shared_indexes(base_directory, db_directory):
+    catalog = open_catalog(os.path.join(cache_path, 'digiAppCatalog.db'))
+    try:
+        for collection in sorted(set(workstation_collections.values()) - {'AU_Herbarium'}):
+            directory = os.path.join(base_directory, '6.Archive', collection)
+            if os.path.isdir(directory):
+                refresh_record_index(catalog, directory, cache_path=cache_path)
+    finally:
+        catalog.close()
+
+    def refresh_database(workstation, db_path):
+        conn = connect_with_cache(db_path, cache_path)
+        try:
+            if not source_has_index_on(conn.cursor(), 'GUID'):
+                refresh_guid_index(conn)
+        finally:
+            conn.close()
+
+    databases = [(ws, os.path.join(db_directory, f"{ws}_jpgs.db")) for ws in workstation_collections]
+    map_databases(refresh_database, [(ws, db_path) for ws, db_path in databases if os.path.exists(db_path)])
+
+# Pull the taxonomy and storage information from the DigiApp exports based on the barcodes
+# The *_original.csv exports in the directory and its subdirectories are indexed by catalog number in the export catalog,
+# which is refreshed incrementally (only exports whose mtime has changed are read again), then all barcodes are looked up at once
+def search_barcodes_in_csv(barcodes, directory, refresh_index=True):
+    # Ensure barcodes are strings and remove leading zeros
+    barcodes_trimmed = [
+        str(barcode).lstrip('0') if barcode and str(barcode).upper() != 'NA' else None
+        for barcode in barcodes
+    ]
+
     try:
-        # csv_files = glob.glob(os.path.join(directory, '*_original.csv'))
-        barcode_trimmed = str(barcode).lstrip('0')  # Ensure barcode is a string and remove leading zeros
-        
-        # Walk through all subdirectories in 'directory'
-        for dirpath, dirnames, filenames in os.walk(directory):
-            csv_files = glob.glob(os.path.join(dirpath, '*_original.csv'))
-
-            for file in csv_files:
-                try:
-                    digiapp_exports_df = pd.read_csv(file, delimiter=';', dtype=str)
-                    if 'catalognumber' in digiapp_exports_df.columns:
-                        digiapp_exports_df['catalognumber_trimmed'] = digiapp_exports_df['catalognumber'].astype(str).str.lstrip('0')
-                        if barcode_trimmed in digiapp_exports_df['catalognumber_trimmed'].values:
-                            matching_row = digiapp_exports_df[digiapp_exports_df['catalognumber_trimmed'] == barcode_trimmed]
-                            return {
-                                'filename': file,
-                                'taxonfullname': matching_row['taxonfullname'].values[0] if 'taxonfullname' in matching_row.columns else None,
-                                'storagefullname': matching_row['storagefullname'].values[0] if 'storagefullname' in matching_row.columns else None,
-                                'storagename': matching_row['storagename'].values[0] if 'storagename' in matching_row.columns else None
-                            }
-                except Exception as e:
-                    print(f"Error reading {file}: {e}")
+        catalog = open_catalog(os.path.join(cache_path, 'digiAppCatalog.db'))
+        try:
+            if refresh_index:
+                refresh_record_index(catalog, directory, cache_path=cache_path)
+            records = lookup_export_records(catalog, directory, {bc for bc in barcodes_trimmed if bc})
+        finally:
+            catalog.close()
     except Exception as e:
-        print(f"Error searching for barcode {barcode}: {e}")
-    
-    return None
+        print(f"Error searching for barcodes in {directory}: {e}")
+        records = {}
+
+    return [records.get(bc) for bc in barcodes_trimmed]
 
-# Pull barcode and date_asset_taken from the SQLite database based on the GUID
-def query_barcodes_and_dates_from_db(workstation, guid, db_directory):
-    if not guid or pd.isna(guid) or guid.strip() == "":
-        print(f"Skipping empty GUID for workstation {workstation}")
-        return [], []
+# Pull barcode and date_asset_taken from the SQLite database based on the GUIDs
+# All GUIDs for a workstation are looked up in one query on one connection, through an index on GUID
+# (the database's own, or one kept in the derived cache). Returns a dict from GUID to (barcodes, dates).
+def query_barcodes_and_dates_from_db(workstation, guids, db_directory, refresh_index=True):
+    guids = [guid for guid in guids if guid and not pd.isna(guid) and guid.strip() != ""]
+    if not guids:
+        return {}
 
     db_path = os.path.join(db_directory, f"{workstation}_jpgs.db")
     if not os.path.exists(db_path):
         print(f"Database not found: {db_path}")
-        return [], []
+        return {}
 
     try:
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-        query = "SELECT barcode, date_asset_taken FROM table1 WHERE GUID = ?"
-        cursor.execute(query, (guid,))
-        results = cursor.fetchall()
-        conn.close()
-
-        barcodes = []
-        dates = []
-        for result in results:
-            barcode = result[0]
-            date_taken = result[1]
-            barcode = barcode.strip("[]").strip("'\"")
+        results = lookup_guid_rows(get_db_connection(db_path), guids, refresh_index)
+
+        barcodes_and_dates = {}
+        for guid, barcode, date_taken in results:
+            barcodes, dates = barcodes_and_dates.setdefault(guid, ([], []))
+            barcode = str(barcode).strip("[]").strip("'\"")
             barcode = barcode.lstrip('0')
             if barcode:
                 barcodes.append(barcode)
             if date_taken:
                 dates.append(date_taken)
 
-        print(f"Found barcodes {barcodes} and dates {dates} for GUID {guid} in {db_path}")
-        return barcodes, dates
+        print(f"Found barcodes for {len(barcodes_and_dates)} of {len(guids)} GUIDs in {db_path}")
+        return barcodes_and_dates
     except Exception as e:
-        print(f"Error querying database {db_path} with GUID {guid}: {e}")
-        return [], []
+        print(f"Error querying database {db_path} with GUIDs: {e}")
+        return {}
 
 # Pull the list of specimens to be re-imaged from the QA_Images_Issues file based on the 'Follow-up Action Required' column
-def read_specimens_xlsx(file_path, base_directory, db_directory):
-    try:
-        xls = pd.ExcelFile(file_path)
-        df = pd.read_excel(
-            xls,
-            sheet_name='Specimens',
-            usecols=[
-                'Workstation', 'Follow-up Action Required', 'GUID',
-                'Folder Date: Year', 'Folder Date: Month', 'Folder Date: Day', 'Barcode'  # <-- include Barcode if it exists
-            ],
-            dtype={'GUID': str, 'Barcode': str}
-        )
-
-        df = df[df['Follow-up Action Required'].str.contains('re-image', case=False, na=False)]
-
-        # --- Only query DB if Barcode is null or empty ---
-        def get_barcodes_and_dates(row):
-            barcode_val = str(row.get('Barcode', '')).strip()
-
-            # Skip querying DB if barcode already present
-            if barcode_val and barcode_val.upper() not in ['NA', 'NAN']:
-                print(f"Skipping DB query — barcode already present for GUID {row['GUID']}")
-                return pd.Series([[], []])
-
-            # Query DB only when Barcode is empty
-            return pd.Series(query_barcodes_and_dates_from_db(row['Workstation'], row['GUID'], db_directory))
-
-        df[['Barcodes_from_DB', 'Dates_from_DB']] = df.apply(get_barcodes_and_dates, axis=1)
-        # Keep rows that have either a Barcode already or DB results
-        df = df[df['Barcodes_from_DB'].apply(lambda x: len(x) > 0) | df['Barcode'].notna()]
-
-        # Merge DB results into Barcode/Date columns
-        df['Barcode'] = df.apply(
-            lambda row: ';'.join(row['Barcodes_from_DB']) if isinstance(row['Barcodes_from_DB'], list) and len(row['Barcodes_from_DB']) > 0 else row.get('Barcode', ''),
-            axis=1
-        )
-        df['Date_Asset_Taken'] = df['Dates_from_DB'].apply(lambda x: ';'.join(x) if isinstance(x, list) else str(x))
-
-        def search_and_extract(row):
-            collection = get_collection(row['Workstation'])
-            # --- Only run search_barcode_in_csv if collection != AU_Herbarium ---
-            if collection == 'AU_Herbarium':
-                print(f"Skipping DigiApp search for AU_Herbarium (Workstation: {row['Workstation']})")
-                return pd.Series({
-                    'filename': None,
-                    'taxonfullname': None,
-                    'storagefullname': None,
-                    'storagename': None
-                })
+# Set refresh_indexes to False if the archive and GUID indexes have already been refreshed (see refresh_shared_indexes)
+def process_specimens_xlsx(file_path, base_directory, db_directory, refresh_indexes=True):
+    # Read the Specimens sheet and the existing Reimage_Needed_ sheets in one pass
+    df, reimage_sheets = read_qa_workbook(
+        file_path,
+        specimens_columns=[
+            'Workstation', 'Follow-up Action Required', 'GUID',
+            'Folder Date: Year', 'Folder Date: Month', 'Folder Date: Day', 'Barcode'  # <-- include Barcode if it exists
+        ],
+        specimens_dtype={'GUID': str, 'Barcode': str}
+    )
+
+    df = df[df['Follow-up Action Required'].str.contains('re-image', case=False, na=False)]
+
+    # --- Only query DB if Barcode is null or empty ---
+    barcode_vals = df['Barcode'].fillna('').astype(str).str.strip()
+    needs_query = (barcode_vals == '') | barcode_vals.str.upper().isin(['NA', 'NAN'])
+    print(f"Skipping DB query — barcode already present for {int((~needs_query).sum())} rows")
+
+    # Query each workstation database once for all of its GUIDs, all databases at the same time
+    to_query = df[needs_query]
+    workstations = [(ws, group['GUID'].dropna().unique().tolist()) for ws, group in to_query.groupby('Workstation')]
+    results = map_databases(
+        lambda workstation, guids: query_barcodes_and_dates_from_db(workstation, guids, db_directory, refresh_indexes),
+        workstations
+    )
+    db_results = pd.Series(
+        {(ws, guid): result for (ws, _), found in zip(workstations, results) for guid, result in found.items()},
+        dtype=object
+    )
+
+    # Merge the results back by (Workstation, GUID)
+    keys = pd.MultiIndex.from_arrays([df['Workstation'], df['GUID']])
+    merged = db_results.reindex(keys) if len(db_results) else pd.Series(None, index=keys, dtype=object)
+    merged = pd.Series(merged.to_numpy(), index=df.index).where(needs_query, None)
+    df['Barcodes_from_DB'] = merged.apply(lambda x: x[0] if isinstance(x, tuple) else [])
+    df['Dates_from_DB'] = merged.apply(lambda x: x[1] if isinstance(x, tuple) else [])
+    # Keep rows that have either a Barcode already or DB results
+    df = df[df['Barcodes_from_DB'].apply(lambda x: len(x) > 0) | df['Barcode'].notna()]
+
+    # Merge DB results into Barcode/Date columns
+    df['Barcode'] = df.apply(
+        lambda row: ';'.join(row['Barcodes_from_DB']) if isinstance(row['Barcodes_from_DB'], list) and len(row['Barcodes_from_DB']) > 0 else row.get('Barcode', ''),
+        axis=1
+    )
+    df['Date_Asset_Taken'] = df['Dates_from_DB'].apply(lambda x: ';'.join(x) if isinstance(x, list) else str(x))
+
+    # Barcode to search for in the DigiApp exports: the first barcode from the DB, otherwise the Barcode column
+    def get_search_barcode(row):
+        if isinstance(row.get('Barcodes_from_DB'), list) and len(row['Barcodes_from_DB']) > 0:
+            return row['Barcodes_from_DB'][0]
+        elif row.get('Barcode'):
+            return row['Barcode']
+        return None
 
-    
-            barcode_list = []
-            if isinstance(row.get('Barcodes_from_DB'), list) and len(row['Barcodes_from_DB']) > 0:
-                barcode_list = row['Barcodes_from_DB']
-            elif row.get('Barcode'):
-                barcode_list = [row['Barcode']]
-
-            if not barcode_list:
-                return pd.Series({'filename': None, 'taxonfullname': None, 'storagefullname': None, 'storagename': None})
-
-            if collection:
-                directory = os.path.join(base_directory, '6.Archive', collection)
-                result = search_barcode_in_csv(barcode_list[0], directory)
-                if result:
-                    return pd.Series(result)
-
-            return pd.Series({'filename': None, 'taxonfullname': None, 'storagefullname': None, 'storagename': None})
-
-        extracted_data = df.apply(search_and_extract, axis=1)
-        new_df = pd.concat([df, extracted_data], axis=1)
-
-        # Create new columns for tracking reimaging status and date, and reorder columns
-        new_df['reimaged'] = ''  # create new blank column for tracking status
-        new_df['date_reimaged'] = ''  # create new blank column for tracking date_reimaged
-        new_df['new_barcode'] = ''  # create new blank column for tracking new barcode if needed
-        new_df['digitizer_comment'] = ''  # create new blank column for tracking digitizer comments during reimaging
-
-        # Define preferred column order
-        preferred_order = ['reimaged', 'date_reimaged', 'Barcode', 'taxonfullname', 'storagename', 'Follow-up Action Required']
-
-        # Keep preferred columns first (if they exist), then all remaining columns
-        ordered_cols = [col for col in preferred_order if col in new_df.columns] + \
-                    [col for col in new_df.columns if col not in preferred_order]
-
-        # Reorder DataFrame
-        new_df = new_df[ordered_cols]
-
-        # --- Write results to Excel ---
-        collections = df['Workstation'].apply(get_collection).unique()
-        with pd.ExcelWriter(file_path, engine='openpyxl', mode='a', if_sheet_exists='overlay') as writer:
-            for collection in collections:
-                collection_df = new_df[df['Workstation'].apply(get_collection) == collection]
-                sheet_name = f'Reimage_Needed_{collection}'
-                try:
-                    existing_df = pd.read_excel(file_path, sheet_name=sheet_name, dtype=str)
-                    collection_df = collection_df[~collection_df['GUID'].isin(existing_df['GUID'])]
-                    combined_df = pd.concat([existing_df, collection_df], ignore_index=True)
-                except ValueError:
-                    combined_df = collection_df
-
-                combined_df.to_excel(writer, sheet_name=sheet_name, index=False)
-
-        return new_df
+    search_barcodes = df.apply(get_search_barcode, axis=1)
+    row_collections = df['Workstation'].apply(get_collection)
 
+    empty_result = {'filename': None, 'taxonfullname': None, 'storagefullname': None, 'storagename': None}
+    extracted_data = pd.DataFrame([empty_result] * len(df), index=df.index)
+
+    # Look up all barcodes of each collection at once
+    for collection in row_collections.dropna().unique():
+        # --- Only search the DigiApp exports if collection != AU_Herbarium ---
+        if collection == 'AU_Herbarium':
+            print("Skipping DigiApp search for AU_Herbarium")
+            continue
+
+        rows = (row_collections == collection) & search_barcodes.notna()
+        directory = os.path.join(base_directory, '6.Archive', collection)
+        results = search_barcodes_in_csv(search_barcodes[rows].tolist(), directory, refresh_indexes)
+        for index, result in zip(search_barcodes[rows].index, results):
+            if result:
+                extracted_data.loc[index, list(result)] = list(result.values())
+
+    new_df = pd.concat([df, extracted_data], axis=1)
+
+    # Create new columns for tracking reimaging status and date, and reorder columns
+    new_df['reimaged'] = ''  # create new blank column for tracking status
+    new_df['date_reimaged'] = ''  # create new blank column for tracking date_reimaged
+    new_df['new_barcode'] = ''  # create new blank column for tracking new barcode if needed
+    new_df['digitizer_comment'] = ''  # create new blank column for tracking digitizer comments during reimaging
+
+    # Define preferred column order
+    preferred_order = ['reimaged', 'date_reimaged', 'Barcode', 'taxonfullname', 'storagename', 'Follow-up Action Required']
+
+    # Keep preferred columns first (if they exist), then all remaining columns
+    ordered_cols = [col for col in preferred_order if col in new_df.columns] + \
+                [col for col in new_df.columns if col not in preferred_order]
+
+    # Reorder DataFrame
+    new_df = new_df[ordered_cols]
+
+    # --- Write results to Excel ---
+    # Merge the new rows into the Reimage_Needed_ sheets in memory, then save the workbook once
+    sheets = {}
+    for collection in row_collections.unique():
+        collection_df = new_df[row_collections == collection]
+        sheet_name = f'Reimage_Needed_{collection}'
+        sheets[sheet_name] = merge_reimage_sheet(reimage_sheets.get(sheet_name), collection_df)
+
+    write_qa_workbook(file_path, sheets)
+
+    return new_df
+
+def read_specimens_xlsx(file_path, base_directory, db_directory):
+    try:
+        return process_specimens_xlsx(file_path, base_directory, db_directory)
     except Exception as e:
         print(f"Error processing Excel file: {e}")
         return pd.DataFrame()
@@ -231,6 +264,8 @@ def read_specimens_xlsx(file_path, base_directory, db_directory):
 #     wb.save(file_path)
 
 
-df = read_specimens_xlsx(file_path, base_directory, db_directory)
-print(df.head())
-#add_excel_formulas(file_path)
\ No newline at end of file
+if __name__ == "__main__":
+    df = read_specimens_xlsx(file_path, base_directory, db_directory)
+    print(df.head())
+
+    #add_excel_formulas(file_path)
\ No newline at end of file
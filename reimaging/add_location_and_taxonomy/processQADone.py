@@ -0,0 +1,81 @@
+# This script runs addLocationAndTaxonomy.py on every QA_Images_Issues spreadsheet in the 2_QA_done folder.
+# Each workbook is first copied to the backup folder with today's date added to the end of the name (YYYYMMDD).
+# All workbooks are then processed at the same time in a pool of worker processes, and the workbooks that were
+# processed successfully are moved to the 3_edits_and_reimaging_in_progress folder.
+# The archive index and the GUID indexes of the workstation databases are refreshed once before the workbooks are processed,
+# so all workers share the same indexes and only read them. Each worker opens its database connections once and reuses them.
+
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from dotenv import load_dotenv
+from addLocationAndTaxonomy import base_directory, db_directory, process_specimens_xlsx, refresh_shared_indexes
+
+# Load environment variables from the .env file
+load_dotenv()
+
+# The backup and in progress folders default to the 'backup' and '3_edits_and_reimaging_in_progress' folders next to 2_QA_done
+qa_done_directory = os.path.normpath(os.getenv("QA_DONE_DIRECTORY", "2_QA_done"))
+backup_directory = os.getenv("BACKUP_DIRECTORY") or os.path.join(os.path.dirname(qa_done_directory), 'backup')
+in_progress_directory = os.getenv("IN_PROGRESS_DIRECTORY") or os.path.join(os.path.dirname(qa_done_directory), '3_edits_and_reimaging_in_progress')
+
+# Number of workbooks processed at the same time (optional, defaults to the number of CPUs)
+max_workers = int(os.getenv("MAX_WORKERS") or os.cpu_count() or 1)
+
+# List the workbooks in the 2_QA_done folder, skipping the lock files Excel creates for open workbooks
+def get_qa_workbooks(directory):
+    return sorted(
+        os.path.join(directory, filename) for filename in os.listdir(directory)
+        if filename.lower().endswith(('.xlsx', '.xlsm')) and not filename.startswith('~$')
+    )
+
+# Copy a workbook to the backup folder with today's date added to the end of the name, e.g. QA_Images_Issues_20250131.xlsx
+def backup_workbook(file_path, backup_directory):
+    os.makedirs(backup_directory, exist_ok=True)
+    name, extension = os.path.splitext(os.path.basename(file_path))
+    backup_path = os.path.join(backup_directory, f"{name}_{datetime.now().strftime('%Y%m%d')}{extension}")
+    if os.path.exists(backup_path):
+        print(f"Backup already exists, not overwriting: {backup_path}")
+    else:
+        shutil.copy2(file_path, backup_path)
+    return backup_path
+
+# Process a single workbook in a worker process. The shared indexes have already been refreshed.
+def process_workbook(file_path):
+    try:
+        process_specimens_xlsx(file_path, base_directory, db_directory, refresh_indexes=False)
+        return True
+    except Exception as e:
+        print(f"Error processing {file_path}: {e}")
+        return False
+
+def process_qa_done(qa_done_directory, backup_directory, in_progress_directory):
+    workbooks = get_qa_workbooks(qa_done_directory)
+    if not workbooks:
+        print(f"No workbooks found in {qa_done_directory}")
+        return
+
+    for file_path in workbooks:
+        backup_workbook(file_path, backup_directory)
+
+    refresh_shared_indexes(base_directory, db_directory)
+
+    with ProcessPoolExecutor(max_workers=min(max_workers, len(workbooks))) as executor:
+        results = list(executor.map(process_workbook, workbooks))
+
+    os.makedirs(in_progress_directory, exist_ok=True)
+    for file_path, succeeded in zip(workbooks, results):
+        destination = os.path.join(in_progress_directory, os.path.basename(file_path))
+        if not succeeded:
+            print(f"Not moving {file_path}, it was not processed")
+        elif os.path.exists(destination):
+            print(f"Not moving {file_path}, {destination} already exists")
+        else:
+            shutil.move(file_path, destination)
+            print(f"Moved {file_path} to {in_progress_directory}")
+
+    print(f"Processed {sum(results)} of {len(workbooks)} workbooks")
+
+if __name__ == "__main__":
+    process_qa_done(qa_done_directory, backup_directory, in_progress_directory)
@@ -0,0 +1,48 @@
+# Workbook layer for the QA_Images_Issues spreadsheet, so that the data is parsed once and the file is saved once per run.
+# All sheets needed are parsed from a single open of the file (with calamine if python-calamine is installed, which is
+# much faster than openpyxl for large workbooks), other sheets such as history sheets are never parsed.
+# The Reimage_Needed_ sheets are merged in memory. To save them, openpyxl loads the workbook a second time (calamine cannot
+# write, and pandas appends to a workbook by loading it with openpyxl), and the sheets and the Specimens Status column are
+# saved in one go.
+
+import importlib.util
+import pandas as pd
+from updateReimagingStatus import get_reimaged_guids, write_reimaging_status
+
+reimage_sheet_prefix = 'Reimage_Needed_'
+
+# Use calamine to read the workbook if it is installed (pip install python-calamine), otherwise openpyxl
+def get_read_engine():
+    return 'calamine' if importlib.util.find_spec('python_calamine') else 'openpyxl'
+
+# Read the Specimens sheet and all Reimage_Needed_ sheets from a single open of the workbook.
+# Returns (specimens_df, reimage_sheets) where reimage_sheets is a dict from sheet name to the sheet as strings.
+def read_qa_workbook(file_path, specimens_columns, specimens_dtype=None):
+    with pd.ExcelFile(file_path, engine=get_read_engine()) as xls:
+        specimens_df = xls.parse('Specimens', usecols=specimens_columns, dtype=specimens_dtype)
+        reimage_sheets = {
+            sheet_name: xls.parse(sheet_name, dtype=str)
+            for sheet_name in xls.sheet_names
+            if sheet_name.startswith(reimage_sheet_prefix)
+        }
+    return specimens_df, reimage_sheets
+
+# Add new rows to a Reimage_Needed_ sheet in memory. Rows with a GUID already in the sheet are skipped.
+def merge_reimage_sheet(existing_df, new_rows):
+    if existing_df is None:
+        return new_rows
+    new_rows = new_rows[~new_rows['GUID'].isin(existing_df['GUID'])]
+    return pd.concat([existing_df, new_rows], ignore_index=True)
+
+# Write the Reimage_Needed_ sheets and update the Status column on the Specimens sheet, then save the workbook once.
+# The workbook is loaded with openpyxl when the writer is opened, and the sheets are written over the existing ones
+# (overlay), so formatting and other sheets are kept.
+def write_qa_workbook(file_path, sheets):
+    # Keep macros if the workbook has been saved as .xlsm
+    engine_kwargs = {'keep_vba': True} if file_path.lower().endswith('.xlsm') else {}
+    with pd.ExcelWriter(file_path, engine='openpyxl', mode='a', if_sheet_exists='overlay', engine_kwargs=engine_kwargs) as writer:
+        for sheet_name, sheet_df in sheets.items():
+            sheet_df.to_excel(writer, sheet_name=sheet_name, index=False)
+
+        reimaged_count = write_reimaging_status(writer.book, get_reimaged_guids(writer.book))
+    print(f"Saved {len(sheets)} sheets to {file_path}: {reimaged_count} specimens reimaged")
@@ -0,0 +1,64 @@
+# This script fills in the 'Status' column on the Specimens tab of a QA_Images_Issues spreadsheet.
+# A specimen is 'reimaged' if its GUID is in any of the Reimage_Needed_<collection> sheets with reimaged = yes.
+# The status is written as static values, which replaces the INDIRECT/COUNTIFS formula that made large workbooks slow to recalculate.
+# It is run at the end of addLocationAndTaxonomy.py, and can be run on its own at any time to refresh the status.
+
+import os
+from openpyxl import load_workbook
+from dotenv import load_dotenv
+
+# Collect the GUIDs marked as reimaged (reimaged = yes) in all Reimage_Needed_ sheets of a workbook
+def get_reimaged_guids(wb):
+    reimaged_guids = set()
+    for sheet_name in wb.sheetnames:
+        if not sheet_name.startswith("Reimage_Needed_"):
+            continue
+        ws = wb[sheet_name]
+        headers = [cell.value for cell in ws[1]]
+        if 'GUID' not in headers or 'reimaged' not in headers:
+            print(f"Sheet {sheet_name} has no GUID or reimaged column, skipping.")
+            continue
+        guid_index = headers.index('GUID')
+        reimaged_index = headers.index('reimaged')
+        for row in ws.iter_rows(min_row=2, values_only=True):
+            if str(row[reimaged_index]).strip().lower() == 'yes' and row[guid_index] is not None:
+                # Match GUIDs case-insensitively, like COUNTIFS does
+                reimaged_guids.add(str(row[guid_index]).strip().lower())
+    return reimaged_guids
+
+# Write the Status of every specimen to the Specimens sheet.
+# The Status column is created after 'Follow-up Action Required' if it does not exist yet.
+def write_reimaging_status(wb, reimaged_guids):
+    ws = wb['Specimens']
+    headers = [cell.value for cell in ws[1]]
+    guid_col = headers.index('GUID') + 1
+
+    if 'Status' in headers:
+        status_col = headers.index('Status') + 1
+    else:
+        status_col = headers.index('Follow-up Action Required') + 2
+        ws.insert_cols(status_col)
+        ws.cell(row=1, column=status_col).value = 'Status'
+        if guid_col >= status_col:
+            guid_col += 1
+
+    reimaged_count = 0
+    for row in range(2, ws.max_row + 1):
+        guid = ws.cell(row=row, column=guid_col).value
+        reimaged = guid is not None and str(guid).strip().lower() in reimaged_guids
+        ws.cell(row=row, column=status_col).value = 'reimaged' if reimaged else None
+        reimaged_count += reimaged
+    return reimaged_count
+
+def update_reimaging_status(file_path):
+    # Keep macros if the workbook has been saved as .xlsm
+    wb = load_workbook(file_path, keep_vba=file_path.lower().endswith('.xlsm'))
+    reimaged_guids = get_reimaged_guids(wb)
+    reimaged_count = write_reimaging_status(wb, reimaged_guids)
+    wb.save(file_path)
+    print(f"Status updated in {file_path}: {reimaged_count} specimens reimaged")
+
+if __name__ == "__main__":
+    # Load environment variables from the .env file
+    load_dotenv()
+    update_reimaging_status(os.getenv("FILE_PATH"))
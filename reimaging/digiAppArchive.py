@@ -0,0 +1,218 @@
+# Shared helpers for the DigiApp export folders (e.g. 3.ReadyForOpenRefine and 6.Archive/<collection>).
+# A catalog of the exports in each folder is kept in a small SQLite database in the local cache folder.
+# It stores the parsed date, collection, variant, delimiter, header and row count of every export, and is
+# updated incrementally: only files that are new or whose mtime or size has changed are opened again.
+# The same database holds an index from catalog number to the taxonomy and storage of the exports' records.
+
+import csv
+import os
+import sqlite3
+from digiAppExportCache import read_export
+from jpgsDatabases import default_cache_path
+
+# Variants of DigiApp exports, from the suffix of the filename
+export_variants = ('_checked_corrected', '_checked', '_original')
+
+# Open (and create if needed) the export catalog
+def open_catalog(catalog_path):
+    os.makedirs(os.path.dirname(os.path.abspath(catalog_path)), exist_ok=True)
+    conn = sqlite3.connect(catalog_path)
+    conn.row_factory = sqlite3.Row
+
+    # The catalog is only a cache, so a catalog from an older version of this script is simply rebuilt
+    columns = [row['name'] for row in conn.execute("PRAGMA table_info(exports)")]
+    if columns and 'recursive' not in columns:
+        conn.execute("DROP TABLE exports")
+
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS exports (
+            folder TEXT NOT NULL,
+            recursive INTEGER NOT NULL,
+            path TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            mtime REAL NOT NULL,
+            size INTEGER NOT NULL,
+            export_date TEXT,
+            collection TEXT,
+            variant TEXT,
+            delimiter TEXT NOT NULL,
+            header TEXT NOT NULL,
+            row_count INTEGER NOT NULL,
+            PRIMARY KEY (folder, recursive, path)
+        );
+        CREATE INDEX IF NOT EXISTS idx_exports_folder_date ON exports (folder, export_date);
+        CREATE TABLE IF NOT EXISTS record_files (
+            path TEXT PRIMARY KEY,
+            mtime REAL NOT NULL,
+            size INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS export_records (
+            path TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            catalognumber TEXT NOT NULL,
+            taxonfullname TEXT,
+            storagefullname TEXT,
+            storagename TEXT,
+            PRIMARY KEY (path, seq)
+        );
+        CREATE INDEX IF NOT EXISTS idx_export_records_catalognumber ON export_records (catalognumber);
+    """)
+    return conn
+
+# Parse the collection, date and variant from an export filename, e.g. NHMD_Herba_20240105_10_00_AB_checked.csv
+# The date is assumed to be in the third position of the filename
+def parse_export_filename(filename):
+    parts = filename.split('_')
+    collection = '_'.join(parts[:2]) if len(parts) > 2 else None
+    export_date = parts[2] if len(parts) > 3 else None
+    variant = next((v for v in export_variants if filename.endswith(f"{v}.csv")), '')
+    return collection, export_date, variant
+
+# Detect the delimiter from the header row, read the header and count the data rows of an export
+def read_export_summary(path):
+    with open(path, 'r', encoding='utf-8-sig', errors='replace', newline='') as file:
+        first_line = file.readline()
+        delimiter = ';' if ';' in first_line else ','
+        row_count = sum(1 for _ in csv.reader(file, delimiter=delimiter))
+    return delimiter, first_line.strip(), row_count
+
+# List all CSV files in a folder (and its subfolders if recursive) with their mtime and size, using os.scandir
+def scan_csv_files(folder, recursive=False):
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if entry.is_dir() and recursive:
+                yield from scan_csv_files(entry.path, recursive)
+            elif entry.is_file() and entry.name.endswith('.csv'):
+                stat = entry.stat()
+                yield entry.path, entry.name, stat.st_mtime, stat.st_size
+
+# Bring the catalog up to date for a folder. Only new or changed files are opened,
+# and files that are no longer in the folder are removed from the catalog.
+def refresh_catalog(conn, folder, recursive=False):
+    known = {
+        row['path']: (row['mtime'], row['size'])
+        for row in conn.execute("SELECT path, mtime, size FROM exports WHERE folder = ? AND recursive = ?", (folder, recursive))
+    }
+
+    updated = 0
+    seen = set()
+    for path, filename, mtime, size in scan_csv_files(folder, recursive):
+        seen.add(path)
+        if known.get(path) == (mtime, size):
+            continue
+
+        try:
+            delimiter, header, row_count = read_export_summary(path)
+        except OSError as e:
+            print(f"Error reading {path}: {e}")
+            continue
+
+        collection, export_date, variant = parse_export_filename(filename)
+        conn.execute(
+            """INSERT OR REPLACE INTO exports
+               (folder, recursive, path, filename, mtime, size, export_date, collection, variant, delimiter, header, row_count)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            (folder, recursive, path, filename, mtime, size, export_date, collection, variant, delimiter, header, row_count)
+        )
+        updated += 1
+
+    removed = [(folder, recursive, path) for path in known if path not in seen]
+    conn.executemany("DELETE FROM exports WHERE folder = ? AND recursive = ? AND path = ?", removed)
+    conn.commit()
+    print(f"Export catalog for {folder}: {len(seen)} files, {updated} new or changed, {len(removed)} removed")
+
+# Select the exports in a folder with a date in the given range (inclusive, YYYYMMDD) and one of the given variants
+def select_exports(conn, folder, start_date, end_date, variants=export_variants, recursive=False):
+    placeholders = ', '.join('?' for _ in variants)
+    return conn.execute(
+        f"""SELECT * FROM exports
+            WHERE folder = ? AND recursive = ? AND export_date BETWEEN ? AND ? AND variant IN ({placeholders})
+            ORDER BY filename""",
+        (folder, recursive, start_date, end_date, *variants)
+    ).fetchall()
+
+# Read the catalognumber, taxonfullname, storagefullname and storagename of every row of an export (from the export cache,
+# which keeps catalog numbers without leading zeros), with the delimiter recorded in the catalog. Rows without a catalog
+# number are left out.
+def read_export_records(path, delimiter, cache_path=default_cache_path):
+    record_columns = ['catalognumber', 'taxonfullname', 'storagefullname', 'storagename']
+    digiapp_exports_df = read_export(path, columns=record_columns, cache_path=cache_path, delimiter=delimiter)
+    if 'catalognumber' not in digiapp_exports_df.columns:
+        return []
+
+    digiapp_exports_df = digiapp_exports_df.reindex(columns=record_columns).astype(object)
+    digiapp_exports_df = digiapp_exports_df.where(digiapp_exports_df.notna(), None)
+    return [
+        (seq, catalognumber, *values)
+        for seq, (catalognumber, *values) in enumerate(digiapp_exports_df.itertuples(index=False, name=None))
+        if catalognumber
+    ]
+
+# Bring the index from catalog number to export records up to date for a folder and all of its subfolders.
+# Only exports of the given variants are indexed, and only files that are new or whose mtime or size has changed are read again.
+def refresh_record_index(conn, folder, variants=('_original',), cache_path=default_cache_path):
+    refresh_catalog(conn, folder, recursive=True)
+
+    placeholders = ', '.join('?' for _ in variants)
+    exports = conn.execute(
+        f"""SELECT e.path, e.mtime, e.size, e.delimiter FROM exports e
+            LEFT JOIN record_files r ON r.path = e.path
+            WHERE e.folder = ? AND e.recursive = 1 AND e.variant IN ({placeholders})
+            AND (r.path IS NULL OR r.mtime != e.mtime OR r.size != e.size)""",
+        (folder, *variants)
+    ).fetchall()
+
+    for export in exports:
+        try:
+            records = read_export_records(export['path'], export['delimiter'], cache_path)
+        except Exception as e:
+            print(f"Error reading {export['path']}: {e}")
+            continue
+
+        with conn:
+            conn.execute("DELETE FROM export_records WHERE path = ?", (export['path'],))
+            conn.executemany(
+                """INSERT INTO export_records (path, seq, catalognumber, taxonfullname, storagefullname, storagename)
+                   VALUES (?, ?, ?, ?, ?, ?)""",
+                [(export['path'], *record) for record in records]
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO record_files (path, mtime, size) VALUES (?, ?, ?)",
+                (export['path'], export['mtime'], export['size'])
+            )
+
+    # Remove records of files that are no longer in any catalogued folder
+    with conn:
+        conn.execute("DELETE FROM export_records WHERE path NOT IN (SELECT path FROM exports)")
+        conn.execute("DELETE FROM record_files WHERE path NOT IN (SELECT path FROM exports)")
+    print(f"Record index for {folder}: {len(exports)} exports read")
+
+# Look up catalog numbers (without leading zeros) in the exports of a folder with a single join.
+# Returns a dict from catalog number to its first record (filename, taxonfullname, storagefullname, storagename).
+def lookup_export_records(conn, folder, catalognumbers, variants=('_original',)):
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS lookup_catalognumbers (catalognumber TEXT PRIMARY KEY)")
+    conn.execute("DELETE FROM temp.lookup_catalognumbers")
+    conn.executemany(
+        "INSERT OR IGNORE INTO temp.lookup_catalognumbers (catalognumber) VALUES (?)",
+        [(cn,) for cn in catalognumbers if cn]
+    )
+
+    placeholders = ', '.join('?' for _ in variants)
+    rows = conn.execute(
+        f"""SELECT r.catalognumber, r.path, r.taxonfullname, r.storagefullname, r.storagename
+            FROM temp.lookup_catalognumbers l
+            JOIN export_records r ON r.catalognumber = l.catalognumber
+            JOIN exports e ON e.path = r.path AND e.folder = ? AND e.recursive = 1 AND e.variant IN ({placeholders})
+            ORDER BY r.path, r.seq""",
+        (folder, *variants)
+    ).fetchall()
+
+    records = {}
+    for row in rows:
+        records.setdefault(row['catalognumber'], {
+            'filename': row['path'],
+            'taxonfullname': row['taxonfullname'],
+            'storagefullname': row['storagefullname'],
+            'storagename': row['storagename']
+        })
+    return records
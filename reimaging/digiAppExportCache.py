@@ -0,0 +1,108 @@
+# Columnar cache of DigiApp exports, shared by searchBarcodesInDatabases.py and addLocationAndTaxonomy.py.
+# Each export is parsed once and stored as an uncompressed Arrow IPC file named after the sha256 of its content, so the same
+# export in 3.ReadyForOpenRefine and in 6.Archive is only converted once, and a changed export gets a new entry.
+# The cached files are read memory-mapped and only the columns asked for are read, e.g. barcode-only readers read just catalognumber.
+# All columns are kept as text as they are in the export, except catalognumber (text without leading zeros) and rankid (Int64).
+# If pyarrow is not installed, the exports are parsed from CSV every time, with the same normalization.
+
+import hashlib
+import os
+import sqlite3
+import uuid
+import pandas as pd
+from jpgsDatabases import default_cache_path
+
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+except ImportError:
+    pa = None
+
+# Change this when the normalization below changes, so that exports cached with the old normalization are converted again
+cache_version = 1
+
+# Read an export from CSV and normalize the dtypes. Pass the delimiter recorded in the export catalog (digiAppArchive.py)
+# if it is known; otherwise it is detected from the header row.
+def read_export_csv(path, delimiter=None):
+    if delimiter is None:
+        with open(path, 'r', encoding='utf-8-sig', errors='replace') as file:
+            delimiter = ';' if ';' in file.readline() else ','
+
+    df = pd.read_csv(path, delimiter=delimiter, dtype=str, encoding='utf-8-sig')
+    # Strip any whitespace or trailing commas from column names
+    df.columns = df.columns.str.strip().str.replace(',', '')
+
+    if 'catalognumber' in df.columns:
+        df['catalognumber'] = df['catalognumber'].str.strip().str.lstrip('0')
+    if 'rankid' in df.columns:
+        df['rankid'] = pd.to_numeric(df['rankid'], errors='coerce').astype('Int64')
+    return df
+
+# Calculate the content hash of a file, reading it in chunks
+def file_sha256(path, chunk_size=1024 * 1024):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+# Get the content hash of an export. Hashes are remembered by path, size and mtime, so unchanged files are not read again.
+def get_export_hash(path, cache_folder):
+    stat = os.stat(path)
+    conn = sqlite3.connect(os.path.join(cache_folder, 'index.db'), timeout=60)
+    try:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS file_hashes (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime REAL NOT NULL,
+                sha256 TEXT NOT NULL
+            )
+        """)
+        row = conn.execute("SELECT size, mtime, sha256 FROM file_hashes WHERE path = ?", (path,)).fetchone()
+        if row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime:
+            return row[2]
+
+        sha256 = file_sha256(path)
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO file_hashes (path, size, mtime, sha256) VALUES (?, ?, ?, ?)",
+                (path, stat.st_size, stat.st_mtime, sha256)
+            )
+        return sha256
+    finally:
+        conn.close()
+
+# Get the path of the cached Arrow file of an export, converting the export if it is not in the cache yet.
+# The file is written under a temporary name and renamed, so other processes never see a partly written file.
+def get_cached_export_path(path, cache_path=default_cache_path, delimiter=None):
+    cache_folder = os.path.join(cache_path, 'digiAppExports')
+    os.makedirs(cache_folder, exist_ok=True)
+
+    cached_path = os.path.join(cache_folder, f"{get_export_hash(path, cache_folder)}.v{cache_version}.arrow")
+    if not os.path.exists(cached_path):
+        table = pa.Table.from_pandas(read_export_csv(path, delimiter), preserve_index=False)
+        temp_path = f"{cached_path}.{uuid.uuid4().hex}.tmp"
+        feather.write_feather(table, temp_path, compression='uncompressed')
+        os.replace(temp_path, cached_path)
+    return cached_path
+
+# Get the column names of an export
+def read_export_columns(path, cache_path=default_cache_path, delimiter=None):
+    if pa is None:
+        return read_export_csv(path, delimiter).columns.tolist()
+    with pa.memory_map(get_cached_export_path(path, cache_path, delimiter)) as source:
+        return pa.ipc.open_file(source).schema.names
+
+# Read an export as a DataFrame. If columns is given, only those columns are read (columns the export does not have are left out).
+def read_export(path, columns=None, cache_path=default_cache_path, delimiter=None):
+    if pa is None:
+        df = read_export_csv(path, delimiter)
+        return df if columns is None else df[[col for col in columns if col in df.columns]]
+
+    cached_path = get_cached_export_path(path, cache_path, delimiter)
+    if columns is not None:
+        with pa.memory_map(cached_path) as source:
+            names = pa.ipc.open_file(source).schema.names
+        columns = [col for col in columns if col in names]
+    return feather.read_table(cached_path, columns=columns, memory_map=True).to_pandas()
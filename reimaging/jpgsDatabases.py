@@ -0,0 +1,287 @@
+# Shared helpers for the workstation barcode-guid matching databases (<workstation>_jpgs.db).
+# The production databases are only ever opened read-only. Any index we need on top of them
+# is kept in a derived cache database (one per workstation database) in a local cache folder.
+
+import glob
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+# Default folder for derived cache databases (can be overridden with CACHE_PATH in the .env file)
+default_cache_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache')
+
+# Get the workstation databases to search from the .env file, as a list of (database name, database path).
+# DATABASES is a comma-separated list of workstations (e.g. WORKPIOF0001, WORKPIOF0002) that are looked up as
+# <workstation>_jpgs.db in DB_DIRECTORY, the same naming addLocationAndTaxonomy.py uses. If DATABASES is empty,
+# every *_jpgs.db in DB_DIRECTORY is used. Without DB_DIRECTORY, DATABASE1/DB_PATH1 and DATABASE2/DB_PATH2 are used.
+def get_workstation_databases():
+    db_directory = os.getenv("DB_DIRECTORY")
+    if db_directory:
+        workstations = [ws.strip() for ws in (os.getenv("DATABASES") or "").split(',') if ws.strip()]
+        if workstations:
+            return [(ws, os.path.join(db_directory, f"{ws}_jpgs.db")) for ws in workstations]
+
+        db_paths = sorted(glob.glob(os.path.join(db_directory, '*_jpgs.db')))
+        if not db_paths:
+            raise ValueError(f"No *_jpgs.db databases found in {db_directory}")
+        return [(os.path.basename(path)[:-len('_jpgs.db')], path) for path in db_paths]
+
+    databases = []
+    for i in (1, 2):
+        database = os.getenv(f"DATABASE{i}")
+        base_db_path = os.getenv(f"DB_PATH{i}")
+        if database and base_db_path:
+            databases.append((database, base_db_path.format(**{f"database{i}": database})))
+    if not databases:
+        raise ValueError("No databases configured, set DB_DIRECTORY (and optionally DATABASES) in the .env file")
+    return databases
+
+# Run func(database, db_path) for every workstation database at the same time, one thread per database.
+# SQLite releases the GIL while a query runs, so the total time is about that of the slowest database.
+# Results are returned in the same order as the databases.
+def map_databases(func, databases):
+    if not databases:
+        return []
+    with ThreadPoolExecutor(max_workers=len(databases)) as executor:
+        return list(executor.map(lambda db: func(*db), databases))
+
+# Helper function to extract barcodes properly from string-like lists, e.g. "['00123', '00124']"
+def process_barcodes(barcode_str):
+    if not barcode_str:
+        return []
+
+    # Remove brackets
+    cleaned = str(barcode_str).replace('[', '').replace(']', '')
+
+    # Split in case of multiple barcodes, then remove quotes, spaces and leading zeros
+    barcodes = [p.strip().replace('"', '').replace("'", '').strip().lstrip('0') for p in cleaned.split(',')]
+    return [bc for bc in barcodes if bc]
+
+# Build a SQLite URI that opens the database read-only (works for Windows drive letters and spaces)
+def read_only_uri(db_path):
+    return Path(db_path).resolve().as_uri() + '?mode=ro'
+
+# Open a workstation database read-only
+def connect_read_only(db_path):
+    return sqlite3.connect(read_only_uri(db_path), uri=True)
+
+# Detect correct column name (barcode vs barcodes) in table1
+def get_barcode_column(cursor, schema='main'):
+    cursor.execute(f"PRAGMA {schema}.table_info(table1)")
+    cols = [row[1] for row in cursor.fetchall()]
+    if "barcodes" in cols:
+        return cols, "barcodes"
+    elif "barcode" in cols:
+        return cols, "barcode"
+    else:
+        raise ValueError("Neither 'barcode' nor 'barcodes' column found in table1")
+
+# Path of the derived cache database for a workstation database
+def get_cache_db_path(db_path, cache_path):
+    db_name = os.path.splitext(os.path.basename(db_path))[0]
+    return os.path.join(cache_path, f"{db_name}_index.db")
+
+# Open the derived cache database with the workstation database attached read-only as 'src'
+def connect_with_cache(db_path, cache_path, check_same_thread=True):
+    os.makedirs(cache_path, exist_ok=True)
+    conn = sqlite3.connect(get_cache_db_path(db_path, cache_path), uri=True, check_same_thread=check_same_thread)
+    conn.execute("ATTACH DATABASE ? AS src", (read_only_uri(db_path),))
+    return conn
+
+# Create or update the normalized barcode index (barcode_norm) in the derived cache.
+# There is one row per barcode in the list column, pointing back to the table1 rowid.
+# The jpgs databases are append-only, so only rows added since the last run are indexed.
+# If table1 has shrunk or the barcode column has changed, the index is rebuilt from scratch.
+def refresh_barcode_index(conn, batch_size=50000):
+    cursor = conn.cursor()
+    _, column_name = get_barcode_column(cursor, schema='src')
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS barcode_index_state (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            barcode_column TEXT NOT NULL,
+            max_rowid INTEGER NOT NULL
+        )
+    """)
+    cursor.execute("CREATE TABLE IF NOT EXISTS barcode_norm (barcode TEXT NOT NULL, row_id INTEGER NOT NULL)")
+
+    cursor.execute("SELECT COALESCE(MAX(rowid), 0) FROM src.table1")
+    source_max_rowid = cursor.fetchone()[0]
+
+    cursor.execute("SELECT barcode_column, max_rowid FROM barcode_index_state WHERE id = 1")
+    state = cursor.fetchone()
+    if state is None or state[0] != column_name or state[1] > source_max_rowid:
+        indexed_max_rowid = 0
+        cursor.execute("DROP INDEX IF EXISTS idx_barcode_norm_barcode")
+        cursor.execute("DELETE FROM barcode_norm")
+    else:
+        indexed_max_rowid = state[1]
+
+    if indexed_max_rowid < source_max_rowid:
+        print(f"Indexing barcodes for rows {indexed_max_rowid + 1} to {source_max_rowid}")
+        read_cursor = conn.cursor()
+        read_cursor.execute(
+            f"SELECT rowid, {column_name} FROM src.table1 WHERE rowid > ? AND rowid <= ?",
+            (indexed_max_rowid, source_max_rowid)
+        )
+        while True:
+            rows = read_cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            cursor.executemany(
+                "INSERT INTO barcode_norm (barcode, row_id) VALUES (?, ?)",
+                [(bc, rowid) for rowid, raw in rows for bc in process_barcodes(str(raw).strip())]
+            )
+
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_barcode_norm_barcode ON barcode_norm (barcode)")
+    cursor.execute(
+        "INSERT OR REPLACE INTO barcode_index_state (id, barcode_column, max_rowid) VALUES (1, ?, ?)",
+        (column_name, source_max_rowid)
+    )
+    conn.commit()
+    return column_name
+
+# SQL expression for the date an image was taken as YYYYMMDD (the same format as START_DATE and END_DATE),
+# from date_asset_taken in table1 (e.g. 2024-01-05T10:31:00 or 2024/01/05 10:31:00 become 20240105)
+date_key_sql = "substr(replace(replace(date_asset_taken, '-', ''), '/', ''), 1, 8)"
+
+# Create or update the index of image dates (asset_dates) in the derived cache, pointing back to the table1 rowid.
+# Like the barcode index, only rows added since the last run are indexed, and the index is rebuilt if table1 has shrunk.
+def refresh_date_index(conn):
+    cursor = conn.cursor()
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS date_index_state (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            max_rowid INTEGER NOT NULL
+        )
+    """)
+    cursor.execute("CREATE TABLE IF NOT EXISTS asset_dates (row_id INTEGER PRIMARY KEY, date_key TEXT)")
+
+    cursor.execute("SELECT COALESCE(MAX(rowid), 0) FROM src.table1")
+    source_max_rowid = cursor.fetchone()[0]
+
+    cursor.execute("SELECT max_rowid FROM date_index_state WHERE id = 1")
+    state = cursor.fetchone()
+    if state is None or state[0] > source_max_rowid:
+        indexed_max_rowid = 0
+        cursor.execute("DELETE FROM asset_dates")
+    else:
+        indexed_max_rowid = state[0]
+
+    if indexed_max_rowid < source_max_rowid:
+        print(f"Indexing image dates for rows {indexed_max_rowid + 1} to {source_max_rowid}")
+        cursor.execute(
+            f"INSERT INTO asset_dates (row_id, date_key) SELECT rowid, {date_key_sql} FROM src.table1 WHERE rowid > ? AND rowid <= ?",
+            (indexed_max_rowid, source_max_rowid)
+        )
+
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_asset_dates_date_key ON asset_dates (date_key)")
+    cursor.execute("INSERT OR REPLACE INTO date_index_state (id, max_rowid) VALUES (1, ?)", (source_max_rowid,))
+    conn.commit()
+
+# Check whether table1 in the attached workstation database already has an index starting with the given column
+def source_has_index_on(cursor, column, schema='src'):
+    for index in cursor.execute(f"PRAGMA {schema}.index_list(table1)").fetchall():
+        index_columns = [row[2] for row in cursor.execute(f"PRAGMA {schema}.index_info('{index[1]}')").fetchall()]
+        if index_columns and str(index_columns[0]).lower() == column.lower():
+            return True
+    return False
+
+# Create or update the index of GUIDs (guid_index) in the derived cache, pointing back to the table1 rowid.
+# It is only needed when the workstation database has no index on GUID itself. Like the other indexes,
+# only rows added since the last run are indexed, and the index is rebuilt if table1 has shrunk.
+def refresh_guid_index(conn):
+    cursor = conn.cursor()
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS guid_index_state (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            max_rowid INTEGER NOT NULL
+        )
+    """)
+    cursor.execute("CREATE TABLE IF NOT EXISTS guid_index (row_id INTEGER PRIMARY KEY, guid TEXT)")
+
+    cursor.execute("SELECT COALESCE(MAX(rowid), 0) FROM src.table1")
+    source_max_rowid = cursor.fetchone()[0]
+
+    cursor.execute("SELECT max_rowid FROM guid_index_state WHERE id = 1")
+    state = cursor.fetchone()
+    if state is None or state[0] > source_max_rowid:
+        indexed_max_rowid = 0
+        cursor.execute("DELETE FROM guid_index")
+    else:
+        indexed_max_rowid = state[0]
+
+    if indexed_max_rowid < source_max_rowid:
+        print(f"Indexing GUIDs for rows {indexed_max_rowid + 1} to {source_max_rowid}")
+        cursor.execute(
+            "INSERT INTO guid_index (row_id, guid) SELECT rowid, GUID FROM src.table1 WHERE rowid > ? AND rowid <= ?",
+            (indexed_max_rowid, source_max_rowid)
+        )
+
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_guid_index_guid ON guid_index (guid)")
+    cursor.execute("INSERT OR REPLACE INTO guid_index_state (id, max_rowid) VALUES (1, ?)", (source_max_rowid,))
+    conn.commit()
+
+# Look up GUIDs with a single join through a temp table, on a connection from connect_with_cache.
+# Uses the GUID index of the workstation database if it has one, otherwise the GUID index in the derived cache,
+# which is brought up to date first unless refresh_index is False (when it has already been refreshed for this run).
+# Returns (GUID, barcode column, date_asset_taken) for every matching row, in rowid order.
+def lookup_guid_rows(conn, guids, refresh_index=True):
+    cursor = conn.cursor()
+    _, column_name = get_barcode_column(cursor, schema='src')
+
+    cursor.execute("CREATE TEMP TABLE IF NOT EXISTS lookup_guids (guid TEXT PRIMARY KEY)")
+    cursor.execute("DELETE FROM temp.lookup_guids")
+    cursor.executemany("INSERT OR IGNORE INTO temp.lookup_guids (guid) VALUES (?)", [(guid,) for guid in guids if guid])
+
+    if source_has_index_on(cursor, 'GUID'):
+        cursor.execute(f"""
+            SELECT t.GUID, t.{column_name}, t.date_asset_taken FROM temp.lookup_guids l
+            JOIN src.table1 t ON t.GUID = l.guid
+            ORDER BY t.rowid
+        """)
+    else:
+        if refresh_index:
+            refresh_guid_index(conn)
+        cursor.execute(f"""
+            SELECT t.GUID, t.{column_name}, t.date_asset_taken FROM temp.lookup_guids l
+            JOIN guid_index g ON g.guid = l.guid
+            JOIN src.table1 t ON t.rowid = g.row_id
+            ORDER BY t.rowid
+        """)
+    return cursor.fetchall()
+
+# Get the current state of a workstation database as (max rowid of table1, file mtime)
+def get_database_state(db_path):
+    conn = connect_read_only(db_path)
+    try:
+        max_rowid = conn.execute("SELECT COALESCE(MAX(rowid), 0) FROM table1").fetchone()[0]
+    finally:
+        conn.close()
+    return max_rowid, os.path.getmtime(db_path)
+
+# Look up normalized barcodes with an exact indexed join and return the matching table1 rows
+# (ordered by rowid, each row only once) together with the table1 column names.
+# Each row starts with its table1 rowid. Only rows with min_rowid < rowid <= max_rowid are returned.
+def lookup_barcode_rows(conn, barcodes, min_rowid=0, max_rowid=None):
+    cursor = conn.cursor()
+    cols, _ = get_barcode_column(cursor, schema='src')
+
+    cursor.execute("CREATE TEMP TABLE IF NOT EXISTS lookup_barcodes (barcode TEXT PRIMARY KEY)")
+    cursor.execute("DELETE FROM temp.lookup_barcodes")
+    cursor.executemany(
+        "INSERT OR IGNORE INTO temp.lookup_barcodes (barcode) VALUES (?)",
+        [(bc,) for bc in barcodes if bc]
+    )
+
+    cursor.execute("""
+        SELECT t.rowid, t.* FROM src.table1 t
+        WHERE t.rowid IN (
+            SELECT n.row_id FROM temp.lookup_barcodes l
+            JOIN barcode_norm n ON n.barcode = l.barcode
+            WHERE n.row_id > ? AND (? IS NULL OR n.row_id <= ?)
+        )
+        ORDER BY t.rowid
+    """, (min_rowid, max_rowid, max_rowid))
+    return cursor.fetchall(), ['rowid'] + cols
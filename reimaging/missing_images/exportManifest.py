@@ -0,0 +1,123 @@
+# Manifest of the DigiApp exports checked by searchBarcodesInDatabases.py, kept in a small SQLite file next to the output files.
+# For each export it records the size, mtime and content hash, and the barcodes read from it. For each export and database it
+# records the database state the export was last reconciled against (max rowid and file mtime) and the rows that were found.
+# On the next run, unchanged exports are not read again, and only rows added to a database since then have to be checked.
+
+import os
+import sqlite3
+from digiAppExportCache import file_sha256
+
+# Open (and create if needed) the manifest database
+def open_manifest(manifest_path):
+    os.makedirs(os.path.dirname(os.path.abspath(manifest_path)), exist_ok=True)
+    conn = sqlite3.connect(manifest_path)
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS exports (
+            path TEXT PRIMARY KEY,
+            filename TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            mtime REAL NOT NULL,
+            sha256 TEXT NOT NULL,
+            barcode_count INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS export_barcodes (
+            path TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            barcode TEXT NOT NULL,
+            PRIMARY KEY (path, seq)
+        );
+        CREATE TABLE IF NOT EXISTS reconciled (
+            path TEXT NOT NULL,
+            database TEXT NOT NULL,
+            db_path TEXT NOT NULL,
+            max_rowid INTEGER NOT NULL,
+            db_mtime REAL NOT NULL,
+            PRIMARY KEY (path, database)
+        );
+        CREATE TABLE IF NOT EXISTS found_rows (
+            path TEXT NOT NULL,
+            database TEXT NOT NULL,
+            row_id INTEGER NOT NULL,
+            barcodes TEXT NOT NULL,
+            PRIMARY KEY (path, database, row_id)
+        );
+    """)
+    return conn
+
+# Check an export against the manifest and return (sha256, barcodes).
+# If size and mtime are unchanged, the file is not read at all. If they have changed but the content has not
+# (e.g. the file was copied), only the hash is calculated. barcodes is None if the export is new or has changed.
+def get_cached_export(conn, path):
+    stat = os.stat(path)
+    row = conn.execute("SELECT size, mtime, sha256 FROM exports WHERE path = ?", (path,)).fetchone()
+
+    if row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime:
+        sha256 = row[2]
+    else:
+        sha256 = file_sha256(path)
+        if row is None or row[2] != sha256:
+            return sha256, None
+        conn.execute("UPDATE exports SET size = ?, mtime = ? WHERE path = ?", (stat.st_size, stat.st_mtime, path))
+        conn.commit()
+
+    barcodes = [bc for (bc,) in conn.execute("SELECT barcode FROM export_barcodes WHERE path = ? ORDER BY seq", (path,))]
+    return sha256, barcodes
+
+# Save a new or changed export with its barcodes. Earlier results for the export are removed.
+def save_export(conn, path, filename, sha256, barcodes):
+    stat = os.stat(path)
+    with conn:
+        conn.execute("DELETE FROM export_barcodes WHERE path = ?", (path,))
+        conn.execute("DELETE FROM reconciled WHERE path = ?", (path,))
+        conn.execute("DELETE FROM found_rows WHERE path = ?", (path,))
+        conn.execute(
+            "INSERT OR REPLACE INTO exports (path, filename, size, mtime, sha256, barcode_count) VALUES (?, ?, ?, ?, ?, ?)",
+            (path, filename, stat.st_size, stat.st_mtime, sha256, len(barcodes))
+        )
+        conn.executemany(
+            "INSERT INTO export_barcodes (path, seq, barcode) VALUES (?, ?, ?)",
+            [(path, seq, bc) for seq, bc in enumerate(barcodes)]
+        )
+
+# Get what is already known about an export in a database, given the current database state (max rowid, mtime).
+# Returns (since_rowid, rows): the rows found up to and including since_rowid, as (rowid, barcodes in row), in rowid order.
+# If since_rowid equals the current max rowid, the export is up to date; otherwise rows after since_rowid must be checked.
+# The databases are append-only, so if rows have been added only the new rows are checked. If the database has shrunk,
+# or it has been modified without adding rows, everything is checked again.
+def get_reconciled_state(conn, path, database, db_path, db_state):
+    max_rowid, db_mtime = db_state
+    row = conn.execute(
+        "SELECT db_path, max_rowid, db_mtime FROM reconciled WHERE path = ? AND database = ?", (path, database)
+    ).fetchone()
+
+    if row is None or row[0] != db_path:
+        return 0, []
+    if row[1] == max_rowid and row[2] == db_mtime:
+        since_rowid = max_rowid
+    elif row[1] < max_rowid:
+        since_rowid = row[1]
+    else:
+        return 0, []
+
+    rows = [
+        (row_id, barcodes.split(',') if barcodes else [])
+        for row_id, barcodes in conn.execute(
+            "SELECT row_id, barcodes FROM found_rows WHERE path = ? AND database = ? AND row_id <= ? ORDER BY row_id",
+            (path, database, since_rowid)
+        )
+    ]
+    return since_rowid, rows
+
+# Save the database state an export has been reconciled against, with all the rows found for it
+def save_reconciled_state(conn, path, database, db_path, db_state, rows):
+    max_rowid, db_mtime = db_state
+    with conn:
+        conn.execute("DELETE FROM found_rows WHERE path = ? AND database = ?", (path, database))
+        conn.execute(
+            "INSERT OR REPLACE INTO reconciled (path, database, db_path, max_rowid, db_mtime) VALUES (?, ?, ?, ?, ?)",
+            (path, database, db_path, max_rowid, db_mtime)
+        )
+        conn.executemany(
+            "INSERT INTO found_rows (path, database, row_id, barcodes) VALUES (?, ?, ?, ?)",
+            [(path, database, row_id, ','.join(barcodes)) for row_id, barcodes in rows]
+        )
@@ -4,9 +4,20 @@
 import pandas as pd
 import sqlite3
 import os
+import sys
 from datetime import datetime
 from dotenv import load_dotenv
 
+# Shared helpers for the barcode-guid matching databases are kept in the reimaging folder
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from jpgsDatabases import (
+    connect_with_cache, default_cache_path, get_database_state, get_workstation_databases, lookup_barcode_rows,
+    map_databases, process_barcodes, refresh_barcode_index
+)
+from digiAppArchive import open_catalog, refresh_catalog, select_exports
+from digiAppExportCache import read_export, read_export_columns
+from exportManifest import get_cached_export, get_reconciled_state, open_manifest, save_export, save_reconciled_state
+
 # Load environment variables from the .env file
 load_dotenv()
 
@@ -15,13 +26,9 @@ collection = os.getenv("COLLECTION")
 start_date = os.getenv("START_DATE") 
 end_date = os.getenv("END_DATE")
 
-database1 = os.getenv("DATABASE1")  
-database2 = os.getenv("DATABASE2")  
-
-base_db_path1 = os.getenv("DB_PATH1")
-base_db_path2 = os.getenv("DB_PATH2")
-db_path1 = base_db_path1.format(database1=database1)
-db_path2 = base_db_path2.format(database2=database2)
+# Databases to search, as (database name, database path): every workstation database in DB_DIRECTORY
+# (or the ones listed in DATABASES), or DATABASE1/DATABASE2 with DB_PATH1/DB_PATH2
+databases = get_workstation_databases()
 
 # Construct the folder path dynamically (update the version in the .env as needed)
 base_folder_path = os.getenv("FOLDER_PATH")
@@ -29,6 +36,9 @@ folder_path = base_folder_path.format(collection=collection)
 
 output_path = os.getenv("OUTPUT_PATH")
 
+# Folder for the derived barcode index databases (optional, defaults to reimaging/cache)
+cache_path = os.getenv("CACHE_PATH") or default_cache_path
+
 # Output CSVs for missing and found barcodes
 today = datetime.today().strftime('%Y%m%d')
 output_missing_csv = f'{output_path}/{collection}_{today}_barcodesMissingFromDB.csv'
@@ -39,138 +49,205 @@ all_missing_barcodes = []
 found_barcodes_with_source = []
 
 # Function to check barcodes in a database
-def check_barcodes_in_db(barcodes, db_path, batch_size=900):
-    # Ensure all barcodes are strings and remove any extra spaces
-    barcodes = [str(bc).strip() for bc in barcodes]
-
-    # Connect to the database
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-
-    # Detect correct column name (barcode vs barcodes)
-    cursor.execute("PRAGMA table_info(table1)")
-    cols = [row[1] for row in cursor.fetchall()]
-    if "barcodes" in cols:
-        column_name = "barcodes"
-    elif "barcode" in cols:
-        column_name = "barcode"
-    else:
-        raise ValueError("Neither 'barcode' nor 'barcodes' column found in table1")
-
-    results = []  # To store all results
-
-    # Process barcodes in batches
-    for i in range(0, len(barcodes), batch_size):
-        batch = barcodes[i:i + batch_size]
-
-        # Dynamically build the query for the current batch size
-        query = "SELECT * FROM table1 WHERE " + " OR ".join([f"TRIM({column_name}) LIKE ?" for _ in batch])
-
-        # Prepare the placeholders for the LIKE query with wildcards
-        placeholders = [f"%{bc}%" for bc in batch]  # Add wildcards for LIKE
-
-        try:
-            # Execute the query for the current batch
-            cursor.execute(query, placeholders)
-            results.extend(cursor.fetchall())  # Collect results from this batch
-        except sqlite3.Error as e:
-            print(f"Error executing batch query: {e}")
-
-    conn.close()
+# Barcodes are matched exactly against the normalized barcode index (barcode_norm) kept in the derived cache,
+# instead of a LIKE '%barcode%' scan of table1 (which was slow and also matched substrings)
+# Returns the matching table1 rows as (rowid, normalized barcodes in row), in rowid order, and the set of all of their barcodes.
+# Only rows with min_rowid < rowid <= max_rowid are checked. If the lookup fails, the rows are None.
+def check_barcodes_in_db(barcodes, db_path, min_rowid=0, max_rowid=None):
+    # Ensure all barcodes are strings, and remove any extra spaces and leading zeros
+    barcodes = [str(bc).strip().lstrip('0') for bc in barcodes]
+
+    # Open the derived cache with the database attached read-only, and bring the barcode index up to date
+    conn = connect_with_cache(db_path, cache_path)
+    try:
+        column_name = refresh_barcode_index(conn)
+        results, cols = lookup_barcode_rows(conn, barcodes, min_rowid, max_rowid)
+    except sqlite3.Error as e:
+        # Return None so that a failed lookup is not recorded in the manifest
+        print(f"Error looking up barcodes in {db_path}: {e}")
+        return None, set()
+    finally:
+        conn.close()
 
     # Extract and normalize barcodes from results
+    row_barcodes = []
     existing_barcodes = set()
     for row in results:
         # Use detected column index instead of assuming column 2
         col_index = cols.index(column_name)
-        existing_barcodes.update(process_barcodes(str(row[col_index]).strip()))
-
-    return results, existing_barcodes
-
-# Helper function to extract barcodes properly from string-like lists
-def extract_barcode(barcode_str):
-    # Clean the string by removing outer brackets and quotes
-    cleaned_str = barcode_str.strip("[]'\"")
-    return cleaned_str
-
-# Helper function to split comma-separated barcodes and clean them
-def process_barcodes(barcode_str):
-    # Split by comma, remove leading/trailing spaces and leading zeros
-    return [bc.strip().lstrip('0') for bc in extract_barcode(barcode_str).split(',')]
-
-# Loop through all CSV files in the folder and filter by date range
-for filename in os.listdir(folder_path):
-    if filename.endswith("_checked.csv") or filename.endswith("_checked_corrected.csv"):
-        print(f"Processing file: {filename}")
-        
-        # Split the filename to extract the date
-        parts = filename.split('_')
-        
-        # Check if the date part is correctly formatted and is the third part
-        if len(parts) > 3:
-            date_str = parts[2]  # This assumes the date is in the third position
-            print(f"Extracted date: {date_str}")
-            
-            # Check if the date falls within the specified range
-            if start_date <= date_str <= end_date:
-                print(f"File {filename} is within the date range.")
-                csv_file = os.path.join(folder_path, filename)
-                
-                # Detect delimiter by reading the first row of the file
-                with open(csv_file, 'r') as file:
-                    first_line = file.readline()
-                    if ';' in first_line:
-                        delimiter = ';'
-                    else:
-                        delimiter = ','
-                
-                print(f"Detected delimiter: {delimiter} for {filename}")
-                
-                # Read the CSV file with the detected delimiter
-                df = pd.read_csv(csv_file, delimiter=delimiter)
-
-                # Ensure the DataFrame has enough columns
-                if df.shape[1] <= 2:  # We need at least 3 columns
-                    print(f"File {filename} doesn't have enough columns, skipping.")
-                    continue
-
-                # Extract the barcodes from the third column (index 2)
-                barcodes = df.iloc[:, 2].tolist()  # Get the values in the third column (catalognumber)
-                print(f"Found {len(barcodes)} barcodes in {filename}.")
-                
-                # Check barcodes in both databases
-                results_db1, existing_barcodes_db1 = check_barcodes_in_db(barcodes, db_path1)
-                results_db2, existing_barcodes_db2 = check_barcodes_in_db(barcodes, db_path2)
-
-                # After retrieving barcodes from the database, clean and process them
-                existing_barcodes = set()
-                for bc in existing_barcodes_db1:
-                    existing_barcodes.update(process_barcodes(str(bc).strip()))  # Properly process each barcode
-                for bc in existing_barcodes_db2:
-                    existing_barcodes.update(process_barcodes(str(bc).strip()))
-
-                print(f"Existing barcodes found: {len(existing_barcodes)}")
-
-                # Ensure that all barcodes are stripped of spaces before comparison
-                barcodes_cleaned = [str(bc).strip() for bc in barcodes]
-                missing_barcodes = [bc for bc in barcodes_cleaned if bc not in existing_barcodes]
-                print(f"Total barcodes processed: {len(barcodes_cleaned)}")
-                print(f"Missing barcodes: {len(missing_barcodes)}")
-
-                # Add missing barcodes and their filenames to the list
-                for barcode in missing_barcodes:
-                    all_missing_barcodes.append({'missing_barcode': barcode, 'filename': filename})
-
-                # Add all barcodes with their source information (ensure they are plain strings)
-                for result in results_db1:
-                    barcodes_in_result = process_barcodes(str(result[2]).strip())  # Process each result
-                    for barcode in barcodes_in_result:
-                        found_barcodes_with_source.append({'barcode': barcode, 'filename': filename, 'database': f'{database1}_jpgs'})
-                
-                for result in results_db2:
-                    barcodes_in_result = process_barcodes(str(result[2]).strip())  # Process each result
-                    for barcode in barcodes_in_result:
-                        found_barcodes_with_source.append({'barcode': barcode, 'filename': filename, 'database': f'{database2}_jpgs'})      
+        barcodes_in_row = process_barcodes(str(row[col_index]).strip())
+        row_barcodes.append((row[0], barcodes_in_row))
+        existing_barcodes.update(barcodes_in_row)
+
+    return row_barcodes, existing_barcodes
+
+# Check the barcodes of all exports in a database, and map each barcode to the positions of the rows it was found in
+def lookup_all_barcodes(all_barcodes, db_path, min_rowid, max_rowid):
+    row_barcodes, _ = check_barcodes_in_db(all_barcodes, db_path, min_rowid, max_rowid)
+    if row_barcodes is None:
+        return None, {}
+
+    rows_by_barcode = {}
+    for pos, (_, barcodes_in_row) in enumerate(row_barcodes):
+        for bc in barcodes_in_row:
+            rows_by_barcode.setdefault(bc, []).append(pos)
+    return row_barcodes, rows_by_barcode
+
+# Pick out the rows found for one export from the results of a lookup done for all exports at once.
+# Rows keep their rowid order, so the result is the same as looking up the export on its own.
+def select_rows_for_export(barcodes, row_barcodes, rows_by_barcode, min_rowid=0):
+    positions = sorted({pos for bc in barcodes for pos in rows_by_barcode.get(str(bc).strip().lstrip('0'), [])})
+    return [row_barcodes[pos] for pos in positions if row_barcodes[pos][0] > min_rowid]
+
+# Add the missing and found barcodes of one export to the output lists
+# db_results is a list of (database name, rows found as (rowid, barcodes in row)), one entry per database
+def add_export_results(filename, barcodes, db_results):
+    # Combine the normalized barcodes found in all databases
+    existing_barcodes = set()
+    for _, rows in db_results:
+        for _, barcodes_in_row in rows:
+            existing_barcodes.update(barcodes_in_row)
+
+    print(f"Existing barcodes found: {len(existing_barcodes)}")
+
+    # Ensure that all barcodes are stripped of spaces before comparison
+    barcodes_cleaned = [str(bc).strip() for bc in barcodes]
+    missing_barcodes = [bc for bc in barcodes_cleaned if bc.lstrip('0') not in existing_barcodes]
+    print(f"Total barcodes processed: {len(barcodes_cleaned)}")
+    print(f"Missing barcodes: {len(missing_barcodes)}")
+
+    # Add missing barcodes and their filenames to the list
+    for barcode in missing_barcodes:
+        all_missing_barcodes.append({'missing_barcode': barcode, 'filename': filename})
+
+    # Add all barcodes with their source information (ensure they are plain strings)
+    for database, rows in db_results:
+        for _, barcodes_in_result in rows:
+            for barcode in barcodes_in_result:
+                found_barcodes_with_source.append({'barcode': barcode, 'filename': filename, 'database': f'{database}_jpgs'})
+
+# Run mode: 'single_pass' (default) first collects the barcodes from every export in the date range and
+# looks them all up in each database once; 'per_file' looks up the barcodes of each export separately
+run_mode = (os.getenv("RUN_MODE") or "single_pass").strip().lower()
+if run_mode not in ("single_pass", "per_file"):
+    raise ValueError(f"Unknown RUN_MODE '{run_mode}', expected 'single_pass' or 'per_file'")
+
+# The manifest remembers which exports have already been checked, and against which state of each database
+manifest_path = os.getenv("MANIFEST_PATH") or os.path.join(output_path, 'missingImagesManifest.db')
+manifest = open_manifest(manifest_path)
+
+# Current state (max rowid, file mtime) of each database
+db_states = dict(map_databases(lambda database, db_path: (database, get_database_state(db_path)), databases))
+
+# Barcodes of each export in the date range, as (filename, file path, barcodes)
+exports = []
+
+# Bring the catalog of exports in the folder up to date, then select the checked exports in the date range
+catalog = open_catalog(os.path.join(cache_path, 'digiAppCatalog.db'))
+refresh_catalog(catalog, folder_path)
+in_range_exports = select_exports(catalog, folder_path, start_date, end_date, variants=('_checked', '_checked_corrected'))
+catalog.close()
+
+for export in in_range_exports:
+    filename = export['filename']
+    csv_file = export['path']
+    print(f"Processing file: {filename} (date {export['export_date']})")
+
+    # Use the barcodes from the manifest if the export has not changed since it was last read
+    sha256, barcodes = get_cached_export(manifest, csv_file)
+    if barcodes is not None:
+        print(f"File {filename} has not changed, using barcodes from the manifest.")
+        exports.append((filename, csv_file, barcodes))
+        continue
+
+    # Ensure the export has enough columns
+    columns = read_export_columns(csv_file, cache_path, export['delimiter'])
+    if len(columns) <= 2:  # We need at least 3 columns
+        print(f"File {filename} doesn't have enough columns, skipping.")
+        continue
+
+    # Read only the barcodes from the export cache: the catalognumber column (third column), without leading zeros
+    barcode_column = 'catalognumber' if 'catalognumber' in columns else columns[2]
+    df = read_export(csv_file, columns=[barcode_column], cache_path=cache_path, delimiter=export['delimiter'])
+    barcodes = [str(bc).strip() for bc in df[barcode_column].dropna().tolist()]
+    print(f"Found {len(barcodes)} barcodes in {filename}.")
+    save_export(manifest, csv_file, filename, sha256, barcodes)
+    exports.append((filename, csv_file, barcodes))
+
+# Find out which rows are already known for each export and database, and which exports need to be checked again
+known_rows = {}
+for _, csv_file, _ in exports:
+    for database, db_path in databases:
+        known_rows[(csv_file, database)] = get_reconciled_state(manifest, csv_file, database, db_path, db_states[database])
+
+# Check the barcodes of all exports that are not up to date in a database in one pass, starting from
+# the earliest row that any of them still needs to be checked against
+def check_all_exports_in_db(database, db_path):
+    stale_exports = [
+        (csv_file, barcodes, known_rows[(csv_file, database)][0]) for _, csv_file, barcodes in exports
+        if known_rows[(csv_file, database)][0] < db_states[database][0]
+    ]
+    if not stale_exports:
+        return []
+
+    all_barcodes = {str(bc).strip().lstrip('0') for _, barcodes, _ in stale_exports for bc in barcodes}
+    min_rowid = min(since_rowid for _, _, since_rowid in stale_exports)
+    print(f"Checking {len(all_barcodes)} unique barcodes from {len(stale_exports)} exports in {database}")
+    row_barcodes, rows_by_barcode = lookup_all_barcodes(all_barcodes, db_path, min_rowid, db_states[database][0])
+    if row_barcodes is None:
+        return []
+
+    # Attribute the rows found back to each export
+    return [
+        (csv_file, select_rows_for_export(barcodes, row_barcodes, rows_by_barcode, since_rowid))
+        for csv_file, barcodes, since_rowid in stale_exports
+    ]
+
+# Rows found in this run, for each export and database that had to be checked
+new_rows = {}
+
+if run_mode == "per_file":
+    # Check the barcodes of each export in all databases that have changed since it was last checked
+    for filename, csv_file, barcodes in exports:
+        stale_databases = [
+            (database, db_path) for database, db_path in databases
+            if known_rows[(csv_file, database)][0] < db_states[database][0]
+        ]
+        if not stale_databases:
+            continue
+        print(f"Checking barcodes from {filename}")
+        results = map_databases(
+            lambda database, db_path: check_barcodes_in_db(
+                barcodes, db_path, known_rows[(csv_file, database)][0], db_states[database][0]
+            )[0],
+            stale_databases
+        )
+        for (database, _), rows in zip(stale_databases, results):
+            if rows is not None:
+                new_rows[(csv_file, database)] = rows
+else:
+    # Check the barcodes of all exports in each database in one pass, all databases at the same time
+    results = map_databases(check_all_exports_in_db, databases)
+    for (database, _), export_rows in zip(databases, results):
+        for csv_file, rows in export_rows:
+            new_rows[(csv_file, database)] = rows
+
+# Combine the rows known from the manifest with the rows found in this run, and update the manifest
+for filename, csv_file, barcodes in exports:
+    print(f"Results for {filename}")
+    db_results = []
+    for database, db_path in databases:
+        since_rowid, rows = known_rows[(csv_file, database)]
+        if (csv_file, database) in new_rows:
+            rows = rows + new_rows[(csv_file, database)]
+            save_reconciled_state(manifest, csv_file, database, db_path, db_states[database], rows)
+        elif since_rowid < db_states[database][0]:
+            # The export has not been checked against this database, e.g. because the lookup failed
+            continue
+        db_results.append((database, rows))
+    add_export_results(filename, barcodes, db_results)
+
+manifest.close()
 
 # Output all missing barcodes to a DataFrame, then to a CSV
 if all_missing_barcodes:
@@ -1,12 +1,22 @@
-# This script reads barcodes from a specified CSV file and checks for their presence in two specified SQLite databases.
+# This script reads barcodes from a specified CSV file and checks for their presence in the specified SQLite databases,
+# for images taken within a specified date range.
 # It outputs a CSV file listing any barcodes found in the databases that are not present in the CSV, along with all their associated metadata.
 
 import pandas as pd
 import sqlite3
 import os
+import shutil
+import sys
 from datetime import datetime
 from dotenv import load_dotenv
 
+# Shared helpers for the barcode-guid matching databases are kept in the reimaging folder
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from jpgsDatabases import (
+    connect_read_only, connect_with_cache, date_key_sql, default_cache_path, get_barcode_column, get_workstation_databases,
+    map_databases, process_barcodes, refresh_date_index
+)
+
 # Load environment variables from the .env file
 load_dotenv()
 
@@ -17,13 +27,9 @@ end_date = os.getenv("END_DATE")
 
 input_csv = os.getenv("INPUT_CSV")
 
-database1 = os.getenv("DATABASE1")  
-database2 = os.getenv("DATABASE2")
-
-base_db_path1 = os.getenv("DB_PATH1")
-base_db_path2 = os.getenv("DB_PATH2")
-db_path1 = base_db_path1.format(database1=database1)
-db_path2 = base_db_path2.format(database2=database2)
+# Databases to search, as (database name, database path): every workstation database in DB_DIRECTORY
+# (or the ones listed in DATABASES), or DATABASE1/DATABASE2 with DB_PATH1/DB_PATH2
+databases = get_workstation_databases()
 
 # Construct the folder path dynamically (update the version in the .env as needed)
 base_folder_path = os.getenv("FOLDER_PATH")
@@ -31,6 +37,13 @@ folder_path = base_folder_path.format(collection=collection)
 
 output_path = os.getenv("OUTPUT_PATH")
 
+# Folder for the derived date index databases (optional, defaults to reimaging/cache)
+cache_path = os.getenv("CACHE_PATH") or default_cache_path
+
+# Only images taken between START_DATE and END_DATE are checked (if set). By default, the dates are looked up
+# in an index kept in the derived cache; set USE_DATE_INDEX to false to filter table1 directly instead.
+use_date_index = (os.getenv("USE_DATE_INDEX") or "true").strip().lower() != "false"
+
 # Output CSVs for missing and found barcodes
 today = datetime.today().strftime('%Y%m%d')
 output_missing_csv = f'{output_path}/{collection}_{today}_barcodesMissingFromDB.csv'
@@ -89,62 +102,87 @@ def check_barcodes_in_db(barcodes, db_path, batch_size=900):
 
     return results, existing_barcodes
 
-# Helper function to extract barcodes properly from string-like lists
-def process_barcodes(barcode_str):
-    if not barcode_str:
-        return []
-
-    # Remove brackets
-    cleaned = barcode_str.replace('[', '').replace(']', '')
-
-    # Split in case of multiple barcodes
-    parts = cleaned.split(',')
-
-    # Clean each barcode
-    return [
-        p.strip().replace('"', '').replace("'", '').lstrip('0')
-        for p in parts
-        if p.strip()
-    ]
-
-def find_db_rows_not_in_csv(db_path, csv_barcodes_set):
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-
-    # Get column info
-    cursor.execute("PRAGMA table_info(table1)")
-    cols_info = cursor.fetchall()
-    col_names = [col[1] for col in cols_info]
-
-    if "barcodes" in col_names:
-        column_name = "barcodes"
-    elif "barcode" in col_names:
-        column_name = "barcode"
+# Vectorized version of process_barcodes (jpgsDatabases.py) for the barcode column of a chunk of table1 rows.
+# Returns the chunk with one row per barcode, and the normalized barcode in the 'unmatched_barcode' column.
+def explode_barcodes(chunk, column_name):
+    # Remove brackets, then split in case of multiple barcodes
+    parts = (
+        chunk[column_name].astype(str).str.strip()
+        .str.replace('[', '', regex=False).str.replace(']', '', regex=False)
+        .str.split(',')
+    )
+    exploded = chunk.assign(unmatched_barcode=parts).explode('unmatched_barcode', ignore_index=True)
+
+    # Clean each barcode, skipping empty parts
+    barcodes = exploded['unmatched_barcode'].fillna('')
+    keep = (barcodes.str.strip() != '').to_numpy()
+    exploded = exploded[keep].reset_index(drop=True)
+    exploded['unmatched_barcode'] = (
+        barcodes[keep].reset_index(drop=True).str.strip()
+        .str.replace('"', '', regex=False).str.replace("'", '', regex=False)
+        .str.lstrip('0')
+    )
+    return exploded
+
+# Stream table1 of a database in chunks and write every row with a barcode that is not in the CSV to output_file.
+# csv_barcodes_index is a pandas Index of the normalized CSV barcodes; its hash table is built once and reused
+# for every chunk. output_columns sets the columns (and their order) of the output file.
+# Memory use is bounded by chunk_size, regardless of the size of the database. Returns the number of rows written.
+def find_db_rows_not_in_csv(db_path, csv_barcodes_index, output_file, output_columns, chunk_size=100000):
+    # Select the rows of images taken in the date range, if one is set
+    if not (start_date or end_date):
+        # The workstation databases are only opened read-only
+        conn = connect_read_only(db_path)
+        query, params = "SELECT * FROM table1", ()
+        schema = 'main'
+    elif use_date_index:
+        # Use the date index in the derived cache, with the database attached read-only
+        conn = connect_with_cache(db_path, cache_path)
+        refresh_date_index(conn)
+        query = """
+            SELECT t.* FROM src.table1 t
+            WHERE t.rowid IN (SELECT row_id FROM asset_dates WHERE date_key BETWEEN ? AND ?)
+            ORDER BY t.rowid
+        """
+        params = (start_date or '00000000', end_date or '99999999')
+        schema = 'src'
     else:
-        raise ValueError("Neither 'barcode' nor 'barcodes' column found in table1")
-
-    barcode_col_index = col_names.index(column_name)
-
-    cursor.execute(f"SELECT * FROM table1")
-
-    rows_not_in_csv = []
+        conn = connect_read_only(db_path)
+        query = f"SELECT * FROM table1 WHERE {date_key_sql} BETWEEN ? AND ?"
+        params = (start_date or '00000000', end_date or '99999999')
+        schema = 'main'
+    cursor = conn.cursor()
 
-    for row in cursor:
-        raw_barcode_field = str(row[barcode_col_index]).strip()
-        db_barcodes = process_barcodes(raw_barcode_field)
+    # Get column info and detect correct column name (barcode vs barcodes)
+    col_names, column_name = get_barcode_column(cursor, schema)
 
-        for bc in db_barcodes:
-            if bc not in csv_barcodes_set:
-                # Convert row to dict so we retain all columns
-                row_dict = dict(zip(col_names, row))
+    rows_written = 0
+    with open(output_file, 'w', newline='', encoding='utf-8') as file:
+        for chunk in pd.read_sql_query(query, conn, params=params, chunksize=chunk_size, dtype=object, coerce_float=False):
+            exploded = explode_barcodes(chunk, column_name)
 
-                # Add the specific barcode that triggered this
-                row_dict["unmatched_barcode"] = bc
+            # Anti-join against the CSV barcodes
+            not_in_csv = csv_barcodes_index.get_indexer(exploded['unmatched_barcode']) < 0
+            rows_not_in_csv = exploded[not_in_csv].reindex(columns=output_columns)
 
-                rows_not_in_csv.append(row_dict)
+            rows_not_in_csv.to_csv(file, header=False, index=False)
+            rows_written += len(rows_not_in_csv)
 
     conn.close()
-    return rows_not_in_csv
+    return rows_written
+
+# Get the output columns for all databases: the table1 columns of each database and the unmatched barcode,
+# in the order they are first seen
+def get_output_columns(databases):
+    output_columns = []
+    for _, db_path in databases:
+        conn = connect_read_only(db_path)
+        col_names, _ = get_barcode_column(conn.cursor())
+        conn.close()
+        for col in col_names + ["unmatched_barcode"]:
+            if col not in output_columns:
+                output_columns.append(col)
+    return output_columns
 
 all_csv_barcodes = set()
 
@@ -177,20 +215,41 @@ all_csv_barcodes = set(
 
 print(f"Total CSV barcodes: {len(all_csv_barcodes)}")
 
-# Get all DB barcodes
-db1_rows = find_db_rows_not_in_csv(db_path1, all_csv_barcodes)
-db2_rows = find_db_rows_not_in_csv(db_path2, all_csv_barcodes)
-
-all_rows = db1_rows + db2_rows
+# Index of the CSV barcodes, used for the anti-join
+csv_barcodes_index = pd.Index(sorted(all_csv_barcodes), dtype=object)
 
-print(f"Total unmatched DB rows: {len(all_rows)}")
+# Number of database rows to read at a time
+chunk_size = int(os.getenv("CHUNK_SIZE") or 100000)
 
 # Output to csv
 output_db_not_in_csv = f'{output_path}/{collection}_{today}_barcodesInDB_NotInCSV.csv'
-
-if all_rows:
-    df = pd.DataFrame(all_rows)
-    df.to_csv(output_db_not_in_csv, index=False)
-    print(f"Written to {output_db_not_in_csv}")
-else:
-    print("No unmatched DB rows found.")
+output_columns = get_output_columns(databases)
+
+# Stream the DB rows not in the CSV to one part file per database, searching all databases at the same time
+part_files = [f'{output_db_not_in_csv}.{database}.part' for database, _ in databases]
+try:
+    rows_written = map_databases(
+        lambda database, db_path: find_db_rows_not_in_csv(
+            db_path, csv_barcodes_index, f'{output_db_not_in_csv}.{database}.part', output_columns, chunk_size
+        ),
+        databases
+    )
+    total_rows = sum(rows_written)
+
+    print(f"Total unmatched DB rows: {total_rows}")
+
+    if total_rows:
+        # Combine the part files, in database order, into the output file
+        with open(output_db_not_in_csv, 'w', newline='', encoding='utf-8') as output_file:
+            pd.DataFrame(columns=output_columns).to_csv(output_file, index=False)
+            for part_file in part_files:
+                with open(part_file, 'r', newline='', encoding='utf-8') as part:
+                    shutil.copyfileobj(part, output_file)
+        print(f"Written to {output_db_not_in_csv}")
+    else:
+        print("No unmatched DB rows found.")
+finally:
+    # Also remove the part files if searching a database failed
+    for part_file in part_files:
+        if os.path.exists(part_file):
+            os.remove(part_file)